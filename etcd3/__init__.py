@@ -1,8 +1,8 @@
 from __future__ import absolute_import
 
 import os
-
-from etcd3._client import Client, SortOrder, SortTarget
+import sys
+from importlib import import_module
 
 ENV_ETCD3_CA = 'ETCD3_CA'
 ENV_ETCD3_ENDPOINT = 'ETCD3_ENDPOINT'
@@ -14,11 +14,53 @@ ENV_ETCD3_TLS_KEY = 'ETCD3_TLS_KEY'
 
 
 __all__ = [
+    'AsyncClient',
+    'Backpressure',
     'Client',
+    'CompareResult',
+    'RetryPolicy',
     'SortOrder',
-    'SortTarget'
+    'SortTarget',
+    'Txn',
+    'WatchFilter'
 ]
 
+# Public names are imported from their modules on first access, so that
+# importing the package does not pay for loading gRPC and the generated
+# protobuf modules until a client is actually used.
+_LAZY_ATTRS = {
+    'AsyncClient': 'etcd3._async_client',
+    'Backpressure': 'etcd3._dispatcher',
+    'Client': 'etcd3._client',
+    'CompareResult': 'etcd3._txn',
+    'RetryPolicy': 'etcd3._retry',
+    'SortOrder': 'etcd3._client',
+    'SortTarget': 'etcd3._client',
+    'Txn': 'etcd3._txn',
+    'WatchFilter': 'etcd3._watcher',
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRS.get(name)
+    if not module_name:
+        raise AttributeError('module %r has no attribute %r' %
+                             (__name__, name))
+
+    value = getattr(import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
+
+
+# Module level __getattr__ is only supported since Python 3.7.
+if sys.version_info < (3, 7):
+    for _name in _LAZY_ATTRS:
+        __getattr__(_name)
+
 _clt = None
 
 
@@ -27,6 +69,7 @@ def client():
     if _clt:
         return _clt
 
+    from etcd3._client import Client
     _clt = Client(endpoints=os.getenv(ENV_ETCD3_ENDPOINT),
                   user=os.getenv(ENV_ETCD3_USER),
                   password=os.getenv(ENV_ETCD3_PASSWORD),
@@ -0,0 +1,555 @@
+import asyncio
+import logging
+from time import time
+
+import grpc
+
+from etcd3 import _utils
+from etcd3._channel_pool import is_transport_error
+from etcd3._client import (SortOrder, SortTarget, _DEFAULT_DISCOVERY_INTERVAL,
+                           _DEFAULT_ETCD_ENDPOINT, _DEFAULT_REQUEST_TIMEOUT,
+                           _DEFAULT_TOKEN_TTL, _EndpointBalancer, _log_retry,
+                           _new_auth_rq, _new_tls_creds)
+from etcd3._endpoint_refresher import _FAILURE_PAUSE, _MIN_REFRESH_INTERVAL
+from etcd3._protobuf.rpc_pb2 import (LeaseGrantRequest, LeaseKeepAliveRequest,
+                                     LeaseRevokeRequest, MemberListRequest,
+                                     WatchCreateRequest, WatchRequest)
+from etcd3._protobuf.rpc_pb2_grpc import (AuthStub, ClusterStub, KVStub,
+                                          LeaseStub, WatchStub)
+from etcd3._retry import RetryPolicy
+from etcd3._token_auth import TokenAuth, is_token_expired
+from etcd3._txn import Txn, new_delete_rq, new_put_rq, new_range_rq
+
+_DEFAULT_SPIN_PAUSE = 3  # seconds
+
+_log = logging.getLogger(__name__)
+
+
+def _reconnect(f):
+    """
+    Asyncio counterpart of `etcd3._client._reconnect`. The channel is closed
+    on transport errors, and the auth token is renewed when it has expired.
+    The decorated method is given the timeout of the attempt as the first
+    argument after self.
+    """
+    async def wrapper(etcd3_clt, *args, **kwargs):
+        assert isinstance(etcd3_clt, AsyncClient)
+        token_auth = etcd3_clt._token_auth
+        deadline = time() + etcd3_clt._timeout
+        attempt = 1
+        while True:
+            token = token_auth and token_auth.token
+            try:
+                await etcd3_clt._ensure_grpc_channel()
+                return await f(etcd3_clt, deadline - time(), *args, **kwargs)
+
+            except grpc.RpcError as err:
+                if is_transport_error(err):
+                    await etcd3_clt._close_grpc_channel()
+                    etcd3_clt._discovery_hint.set()
+
+                elif is_token_expired(err):
+                    await etcd3_clt._renew_token(token)
+
+                delay = etcd3_clt._retry_policy.next_delay(
+                    attempt, err, deadline - time())
+                if delay is None:
+                    raise
+
+                _log_retry(err, delay, f, args, kwargs)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    return wrapper
+
+
+class AsyncClient(object):
+    """
+    Asyncio counterpart of `Client` built on `grpc.aio` channels. Watches and
+    lease keep-alives are served by coroutines rather than by threads. The
+    client can be created outside of the event loop it is used in.
+    """
+
+    def __init__(self, endpoints=None, user=None, password=None, timeout=None,
+                 cert=None, cert_key=None, cert_ca=None, with_tls=False,
+                 retry_policy=None, discovery_interval=None, token_ttl=None):
+        endpoints = endpoints or _DEFAULT_ETCD_ENDPOINT
+        self._endpoint_balancer = _EndpointBalancer(endpoints)
+        self._tls_creds = _new_tls_creds(cert, cert_key, cert_ca, with_tls)
+        self._auth_rq = _new_auth_rq(user, password)
+        if self._auth_rq and not self._tls_creds:
+            raise AttributeError('Authentication is only allowed via TLS')
+
+        self._timeout = timeout or _DEFAULT_REQUEST_TIMEOUT
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._token_auth = None
+        if self._auth_rq:
+            self._token_auth = TokenAuth(self, self._auth_rq,
+                                         token_ttl or _DEFAULT_TOKEN_TTL)
+
+        # Asyncio primitives are created by `_ensure_loop_primitives` in the
+        # event loop, for before Python 3.10 they bind to the event loop that
+        # is current when they are created.
+        self._grpc_channel_mu = None
+        self._auth_mu = None
+        self._discovery_hint = None
+        self._grpc_channel = None
+        self._auth_stub = None
+        self._kv_stub = None
+        self._watch_stub = None
+        self._lease_stub = None
+        self._cluster_stub = None
+
+        self._discovery_interval = (discovery_interval or
+                                    _DEFAULT_DISCOVERY_INTERVAL)
+        self._discovery_task = None
+        self._token_refresh_task = None
+
+        # For tests only!
+        self._skip_endpoint_discovery = False
+
+    @property
+    def current_endpoint(self):
+        return self._endpoint_balancer.current_endpoint
+
+    async def get(self, key, is_prefix=False, limit=0,
+                  sort_order=SortOrder.NONE, sort_target=SortTarget.KEY,
+                  **kwargs):
+        """
+        Reads a key, or all keys with the given prefix. It accepts the same
+        arguments as `Client.get`.
+        """
+        rq = new_range_rq(key, is_prefix, limit,
+                          sort_order.value, sort_target.value, **kwargs)
+        return await self._range(rq)
+
+    async def get_value(self, key):
+        """
+        Convenience wrapper around `get`. It returns value only, or None if the
+        key does not exist.
+        """
+        rs = await self.get(key)
+        if rs.count == 0:
+            return None
+
+        return rs.kvs[0].value
+
+    async def count(self, prefix, serializable=False):
+        rs = await self.get(prefix, is_prefix=True, count_only=True,
+                            serializable=serializable)
+        return rs.count
+
+    async def keys(self, prefix, serializable=False):
+        rs = await self.get(prefix, is_prefix=True, keys_only=True,
+                            serializable=serializable)
+        return [kv.key for kv in rs.kvs]
+
+    async def put(self, key, val, lease_id=None):
+        rq = new_put_rq(key, val, lease_id)
+        return await self._put(rq)
+
+    async def delete(self, key, is_prefix=False):
+        rq = new_delete_rq(key, is_prefix)
+        return await self._delete_range(rq)
+
+    def txn(self):
+        """
+        Returns a transaction builder, see `Txn` for details. Its `commit`
+        method returns an awaitable.
+        """
+        return Txn(self)
+
+    async def lease_grant(self, ttl):
+        rq = LeaseGrantRequest(TTL=ttl)
+        return await self._lease_grant(rq)
+
+    async def lease_revoke(self, lease_id):
+        rq = LeaseRevokeRequest(ID=lease_id)
+        return await self._lease_revoke(rq)
+
+    async def watch(self, key, is_prefix=False, start_revision=0,
+                    spin_pause=None, compacted_handler=None):
+        """
+        Async generator of events on a key, or on all keys with the given
+        prefix. If the watch stream fails, it is restored and resumed from the
+        revision following the last received event, so no events are missed.
+        The watch is cancelled when the generator is closed.
+
+        If the revision to resume from has been compacted, then
+        `compacted_handler` is called with the compact revision and returns
+        the revision to resume from. Without it events up to the compact
+        revision are skipped. If Etcd cancels the watch for another reason,
+        then it is created again after `spin_pause`.
+        """
+        spin_pause = spin_pause or _DEFAULT_SPIN_PAUSE
+        watch_create_rq = WatchCreateRequest(key=_utils.to_bytes(key),
+                                             start_revision=start_revision)
+        if is_prefix:
+            watch_create_rq.range_end = _utils.range_end(watch_create_rq.key)
+
+        while True:
+            try:
+                # Test if the key can be accessed. That is needed to trigger
+                # reconnects and also checks if there is enough permissions.
+                # Only the count is requested, for a prefix can be huge.
+                await self.get(key, is_prefix, limit=1, count_only=True)
+
+                watch_stub = await self._get_watch_stub()
+                grpc_stream = watch_stub.Watch()
+                await grpc_stream.write(
+                    WatchRequest(create_request=watch_create_rq))
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                _log.exception('Failed to initialize watch: %s', key)
+                await asyncio.sleep(spin_pause)
+                continue
+
+            try:
+                while True:
+                    rs = await grpc_stream.read()
+                    if rs is grpc.aio.EOF:
+                        raise RuntimeError('Watch stream closed unexpectedly')
+
+                    if rs.created:
+                        _log.info('Watch created: %s', key)
+                        # See `etcd3._watcher.Watcher`.
+                        if not watch_create_rq.start_revision:
+                            watch_create_rq.start_revision = (
+                                rs.header.revision + 1)
+
+                    if rs.compact_revision:
+                        if compacted_handler:
+                            watch_create_rq.start_revision = (
+                                compacted_handler(rs.compact_revision))
+                        else:
+                            _log.error('Watch revision compacted, events '
+                                       'before %d are lost: %s',
+                                       rs.compact_revision, key)
+                            watch_create_rq.start_revision = (
+                                rs.compact_revision)
+                        break
+
+                    if rs.canceled:
+                        _log.error('Watch canceled: %s, reason=%s', key,
+                                   rs.cancel_reason)
+                        await asyncio.sleep(spin_pause)
+                        break
+
+                    if not rs.events and not rs.created:
+                        # A progress notification, all events up to the
+                        # header revision have been received.
+                        watch_create_rq.start_revision = max(
+                            watch_create_rq.start_revision,
+                            rs.header.revision + 1)
+
+                    for e in rs.events:
+                        watch_create_rq.start_revision = e.kv.mod_revision + 1
+                        yield e
+
+            except grpc.RpcError as err:
+                severity = logging.ERROR
+                if err.code() == grpc.StatusCode.CANCELLED:
+                    severity = logging.WARN
+
+                _log.log(severity, 'Watch stream failed: %s', key)
+                await asyncio.sleep(spin_pause)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                _log.exception('Watch stream failed: %s', key)
+                await asyncio.sleep(spin_pause)
+
+            finally:
+                grpc_stream.cancel()
+
+    async def keep_alive(self, key, value, ttl, spin_pause=None):
+        """
+        Coroutine that keeps a key with the given value in Etcd for as long as
+        it runs, re-creating the lease if it is lost. It is supposed to be run
+        as a task, and when the task is cancelled the key is deleted and the
+        lease is revoked, e.g.:
+
+            task = asyncio.ensure_future(clt.keep_alive('/foo', 'bar', 10))
+            ...
+            task.cancel()
+        """
+        spin_pause = spin_pause or _DEFAULT_SPIN_PAUSE
+        lease_id = None
+        try:
+            while True:
+                try:
+                    lease_grant_rs = await self.lease_grant(ttl)
+                    lease_id = lease_grant_rs.ID
+                    refresh_interval = lease_grant_rs.TTL * 2 / 3.
+                    lease_keep_alive_rq = LeaseKeepAliveRequest(ID=lease_id)
+
+                    await self.put(key, value, lease_id)
+                    _log.debug('Volatile key stored: %s, value=%s, ttl=%d, ',
+                               key, value, lease_grant_rs.TTL)
+
+                    lease_stub = await self._get_lease_stub()
+                    grpc_stream = lease_stub.LeaseKeepAlive()
+
+                except asyncio.CancelledError:
+                    raise
+
+                except Exception:
+                    _log.exception('Failed to register: %s', key)
+                    await asyncio.sleep(spin_pause)
+                    continue
+
+                try:
+                    while True:
+                        await asyncio.sleep(refresh_interval)
+                        await grpc_stream.write(lease_keep_alive_rq)
+                        rs = await asyncio.wait_for(grpc_stream.read(),
+                                                    self._timeout)
+                        if rs is grpc.aio.EOF or rs.TTL <= 0:
+                            _log.error('Lease lost: %s', lease_id)
+                            break
+
+                        _log.debug('Lease refreshed: %s, rs=%s', lease_id, rs)
+
+                except asyncio.CancelledError:
+                    raise
+
+                except Exception:
+                    _log.exception('Failed to refresh lease: %s', lease_id)
+
+                finally:
+                    grpc_stream.cancel()
+        finally:
+            if lease_id:
+                try:
+                    await self.delete(key)
+
+                except Exception:
+                    _log.exception('Failed to delete key: %s', key)
+
+                try:
+                    await self.lease_revoke(lease_id)
+
+                except Exception:
+                    _log.exception('Failed to revoke lease: %s', lease_id)
+
+    async def close(self):
+        if self._discovery_task:
+            self._discovery_task.cancel()
+            self._discovery_task = None
+
+        if self._token_refresh_task:
+            self._token_refresh_task.cancel()
+            self._token_refresh_task = None
+
+        await self._close_grpc_channel()
+
+    @_reconnect
+    async def _range(self, timeout, rq):
+        return await self._kv_stub.Range(rq, timeout=timeout)
+
+    @_reconnect
+    async def _put(self, timeout, rq):
+        return await self._kv_stub.Put(rq, timeout=timeout)
+
+    @_reconnect
+    async def _delete_range(self, timeout, rq):
+        return await self._kv_stub.DeleteRange(rq, timeout=timeout)
+
+    @_reconnect
+    async def _txn(self, timeout, rq):
+        return await self._kv_stub.Txn(rq, timeout=timeout)
+
+    def _txn_async(self, rq):
+        # Used by `Txn.commit_async`, that returns an asyncio task then.
+        return asyncio.ensure_future(self._txn(rq))
+
+    @_reconnect
+    async def _lease_grant(self, timeout, rq):
+        return await self._lease_stub.LeaseGrant(rq, timeout=timeout)
+
+    @_reconnect
+    async def _lease_revoke(self, timeout, rq):
+        return await self._lease_stub.LeaseRevoke(rq, timeout=timeout)
+
+    @_reconnect
+    async def _authenticate(self, timeout, rq):
+        return await self._auth_stub.Authenticate(rq, timeout=timeout)
+
+    @_reconnect
+    async def _member_list(self, timeout, rq):
+        return await self._cluster_stub.MemberList(rq, timeout=timeout)
+
+    @_reconnect
+    async def _get_watch_stub(self, timeout):
+        return self._watch_stub
+
+    @_reconnect
+    async def _get_lease_stub(self, timeout):
+        return self._lease_stub
+
+    def _ensure_loop_primitives(self):
+        if self._grpc_channel_mu:
+            return
+
+        self._grpc_channel_mu = asyncio.Lock()
+        self._auth_mu = asyncio.Lock()
+        self._discovery_hint = asyncio.Event()
+
+    async def _ensure_grpc_channel(self):
+        self._ensure_loop_primitives()
+        async with self._grpc_channel_mu:
+            if self._grpc_channel:
+                return
+
+            await self._ensure_grpc_channel_unsafe()
+
+    async def _close_grpc_channel(self):
+        self._ensure_loop_primitives()
+        async with self._grpc_channel_mu:
+            await self._close_grpc_channel_unsafe()
+
+    async def _ensure_grpc_channel_unsafe(self):
+        endpoint = self._endpoint_balancer.rotate_endpoint()
+        self._grpc_channel = await self._dial(endpoint)
+        self._auth_stub = AuthStub(self._grpc_channel)
+        self._kv_stub = KVStub(self._grpc_channel)
+        self._watch_stub = WatchStub(self._grpc_channel)
+        self._lease_stub = LeaseStub(self._grpc_channel)
+        self._cluster_stub = ClusterStub(self._grpc_channel)
+
+        if not self._skip_endpoint_discovery and not self._discovery_task:
+            self._discovery_task = asyncio.ensure_future(
+                self._refresh_endpoints())
+
+    async def _refresh_endpoints(self):
+        """
+        Coroutine counterpart of `EndpointRefresher`, it runs as a task until
+        the client is closed.
+        """
+        while True:
+            try:
+                await self._discover_endpoints()
+                pause = self._discovery_interval
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                _log.exception('Failed to discover endpoints')
+                pause = min(self._discovery_interval, _FAILURE_PAUSE)
+
+            self._discovery_hint.clear()
+            try:
+                await asyncio.wait_for(self._discovery_hint.wait(), pause)
+                await asyncio.sleep(_MIN_REFRESH_INTERVAL)
+
+            except asyncio.TimeoutError:
+                pass
+
+    async def _discover_endpoints(self):
+        rs = await self._member_list(MemberListRequest())
+        balancer = self._endpoint_balancer
+        balancer.refresh(rs.members, balancer.current_endpoint)
+
+    async def _close_grpc_channel_unsafe(self):
+        if not self._grpc_channel:
+            return
+        try:
+            await self._grpc_channel.close()
+        except Exception:
+            _log.exception('Failed to close Etcd client gRPC channel')
+
+        self._grpc_channel = None
+
+    async def _dial(self, endpoint):
+        if not self._tls_creds:
+            return grpc.aio.insecure_channel(endpoint)
+
+        if not self._token_auth:
+            return grpc.aio.secure_channel(endpoint, self._tls_creds)
+
+        creds = grpc.composite_channel_credentials(self._tls_creds,
+                                                   self._token_auth.call_creds)
+        grpc_channel = grpc.aio.secure_channel(endpoint, creds)
+        try:
+            await self._ensure_token(grpc_channel)
+
+        except Exception:
+            await grpc_channel.close()
+            raise
+
+        return grpc_channel
+
+    async def _ensure_token(self, grpc_channel):
+        """
+        Counterpart of `TokenAuth.ensure_token`. The token is renewed by a
+        task rather than by a thread.
+        """
+        if self._token_auth.authenticated:
+            return
+
+        async with self._auth_mu:
+            if self._token_auth.authenticated:
+                return
+
+            try:
+                rs = await AuthStub(grpc_channel).Authenticate(
+                    self._auth_rq, timeout=self._timeout)
+
+            except grpc.RpcError as e:
+                if "authentication is not enabled" not in e.details():
+                    raise
+
+                _log.error("server authentication disabled; skipping")
+                rs = None
+
+            self._token_auth.set_token(rs)
+
+        if self._token_auth.token and not self._token_refresh_task:
+            self._token_refresh_task = asyncio.ensure_future(
+                self._refresh_token())
+
+    async def _renew_token(self, stale_token):
+        try:
+            async with self._auth_mu:
+                if self._token_auth.token != stale_token:
+                    return
+
+                _log.info('Renewing rejected auth token')
+                rs = await self._authenticate(self._auth_rq)
+                self._token_auth.set_token(rs)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            _log.exception('Failed to renew auth token')
+
+    async def _refresh_token(self):
+        """
+        Coroutine counterpart of the `TokenAuth` renewal thread, it runs as a
+        task until the client is closed.
+        """
+        pause = self._token_auth.refresh_interval
+        while True:
+            await asyncio.sleep(pause)
+            try:
+                async with self._auth_mu:
+                    rs = await self._authenticate(self._auth_rq)
+                    self._token_auth.set_token(rs)
+
+                pause = self._token_auth.refresh_interval
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                _log.exception('Failed to renew auth token')
+                pause = min(self._token_auth.refresh_interval,
+                            _FAILURE_PAUSE)
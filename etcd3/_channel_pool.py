@@ -0,0 +1,261 @@
+import logging
+from collections import deque
+from itertools import count
+from threading import Lock
+
+import grpc
+
+from etcd3._protobuf.rpc_pb2_grpc import (AuthStub, ClusterStub, KVStub,
+                                          LeaseStub, WatchStub)
+
+# A connection is considered broken after that many calls in a row made over
+# it exceeded their deadlines. That is how a connection silently dropped by
+# the network usually shows.
+_MAX_DEADLINE_OVERRUNS = 3
+
+_log = logging.getLogger(__name__)
+
+# Channels inherited from the parent process by pools of all clients. They
+# are never closed, nor garbage collected, even with the pool they belonged
+# to, for that would touch gRPC state that belongs to the parent.
+_inherited_conns = []
+
+
+class GrpcConn(object):
+    """
+    gRPC channel of a pool member along with stubs of the Etcd services
+    that are called over it.
+    """
+
+    def __init__(self, slot, endpoint, grpc_channel):
+        self.slot = slot
+        self.endpoint = endpoint
+        self.grpc_channel = grpc_channel
+        self.kv_stub = KVStub(grpc_channel)
+        self.watch_stub = WatchStub(grpc_channel)
+        self.lease_stub = LeaseStub(grpc_channel)
+        self.cluster_stub = ClusterStub(grpc_channel)
+        self.auth_stub = AuthStub(grpc_channel)
+        self.deadline_overruns = 0
+
+
+class GrpcChannelPool(object):
+    """
+    Fixed size pool of gRPC channels, every one of them is a separate HTTP/2
+    connection. Pool members are connected lazily by the `connect` function
+    and reconnect independently of each other. Unary calls are given the
+    member with the least calls in flight, ties are broken round-robin, and
+    streams are spread across members by the number of open streams.
+
+    If `endpoint_cost` function is given, then the number of calls in flight
+    on a member is weighted by the cost of the endpoint it is connected to.
+
+    Connections are published as an immutable tuple that is replaced as a
+    whole when a member is connected or closed, so acquiring a connected
+    member takes no locks. Locks are only taken to connect and close members.
+    """
+
+    def __init__(self, size, connect, endpoint_cost=None):
+        self._connect = connect
+        self._endpoint_cost = endpoint_cost
+        self._mu = Lock()
+        self._slot_mus = [Lock() for _ in range(size)]
+        self._conns = (None,) * size
+        self._failed_endpoints = [None] * size
+        # Calls and streams in flight are counted by the lengths of deques,
+        # for appending to and popping from a deque are atomic.
+        self._calls = [deque() for _ in range(size)]
+        self._streams = [deque() for _ in range(size)]
+        self._round_robin = count()
+
+    @property
+    def size(self):
+        return len(self._conns)
+
+    def acquire(self):
+        """
+        Returns a connection to make a unary call with. It must be given back
+        with `release` when the call is completed.
+        """
+        return self._acquire(self._calls, self._endpoint_cost)
+
+    def acquire_other(self, endpoint):
+        """
+        Returns a connection to an endpoint other than the given one to make
+        a unary call with, or None if no pool member is connected to such.
+        Members are not connected by this method. It must be given back with
+        `release` when the call is completed.
+        """
+        conns = self._conns
+        slot = None
+        slot_load = None
+        for candidate, conn in enumerate(conns):
+            if not conn or conn.endpoint == endpoint:
+                continue
+
+            load = self._load(conns, self._calls, candidate,
+                              self._endpoint_cost)
+            if slot is None or load < slot_load:
+                slot = candidate
+                slot_load = load
+
+        if slot is None:
+            return None
+
+        self._calls[slot].append(None)
+        return conns[slot]
+
+    def release(self, conn):
+        self._calls[conn.slot].pop()
+
+    def acquire_stream(self):
+        """
+        Returns a connection to open a stream with. It must be given back
+        with `release_stream` when the stream is closed.
+        """
+        return self._acquire(self._streams)
+
+    def release_stream(self, conn):
+        self._streams[conn.slot].pop()
+
+    def is_closed(self, conn):
+        """
+        Tells if the connection has been closed by the pool. A connection can
+        be closed by another thread after it has been acquired, and calls
+        made over it then fail.
+        """
+        return self._conns[conn.slot] is not conn
+
+    def report(self, conn, err=None):
+        """
+        Tracks health of a connection by the outcomes of calls and streams
+        made over it. On transport errors, see `is_transport_error`, all
+        connections to the same endpoint are closed, for they are most likely
+        broken too. The connection alone is closed when calls over it keep
+        exceeding their deadlines. Any other error is an error of the call
+        rather than of the connection, so the connection and other calls and
+        streams on it are left intact.
+        """
+        if err is None:
+            conn.deadline_overruns = 0
+            return
+
+        if (isinstance(err, grpc.RpcError) and
+                err.code() == grpc.StatusCode.DEADLINE_EXCEEDED):
+            conn.deadline_overruns += 1
+            if conn.deadline_overruns < _MAX_DEADLINE_OVERRUNS:
+                return
+
+            _log.warn('Calls keep exceeding deadline: %s', conn.endpoint)
+            self.close(conn)
+
+        elif is_transport_error(err):
+            self._close_endpoint(conn.endpoint)
+
+    def close(self, conn):
+        """
+        Closes the connection of the pool member that `conn` belongs to,
+        unless it has already been replaced. The member is reconnected when
+        it is acquired next time, to a different endpoint if there is one.
+        """
+        with self._slot_mus[conn.slot]:
+            if self._conns[conn.slot] is conn:
+                self._close_unsafe(conn.slot, failed=True)
+
+    def close_all(self):
+        for slot in range(self.size):
+            with self._slot_mus[slot]:
+                self._close_unsafe(slot)
+
+    def _after_fork(self):
+        """
+        Called in a child process after fork. Channels inherited from the
+        parent are dropped and pool members are connected anew on demand.
+        """
+        self._mu = Lock()
+        self._slot_mus = [Lock() for _ in range(self.size)]
+        _inherited_conns.extend(conn for conn in self._conns if conn)
+        self._conns = (None,) * self.size
+        self._failed_endpoints = [None] * self.size
+        self._calls = [deque() for _ in range(self.size)]
+        self._streams = [deque() for _ in range(self.size)]
+
+    def _acquire(self, loads, endpoint_cost=None):
+        conns = self._conns
+        size = len(conns)
+        slot = 0
+        if size > 1:
+            slot_load = None
+            first = next(self._round_robin)
+            for i in range(size):
+                candidate = (first + i) % size
+                load = self._load(conns, loads, candidate, endpoint_cost)
+                if slot_load is None or load < slot_load:
+                    slot = candidate
+                    slot_load = load
+
+        loads[slot].append(None)
+        conn = conns[slot]
+        if conn:
+            return conn
+
+        try:
+            with self._slot_mus[slot]:
+                return self._ensure_unsafe(slot)
+
+        except Exception:
+            loads[slot].pop()
+            raise
+
+    def _close_endpoint(self, endpoint):
+        for slot in range(self.size):
+            with self._slot_mus[slot]:
+                conn = self._conns[slot]
+                if conn and conn.endpoint == endpoint:
+                    self._close_unsafe(slot, failed=True)
+
+    def _load(self, conns, loads, slot, endpoint_cost):
+        if not endpoint_cost:
+            return len(loads[slot])
+
+        conn = conns[slot]
+        return (len(loads[slot]) + 1) * endpoint_cost(conn and conn.endpoint)
+
+    def _ensure_unsafe(self, slot):
+        conn = self._conns[slot]
+        if not conn:
+            conn = self._connect(slot, self._failed_endpoints[slot])
+            self._publish(slot, conn)
+            self._failed_endpoints[slot] = None
+
+        return conn
+
+    def _close_unsafe(self, slot, failed=False):
+        conn = self._conns[slot]
+        if not conn:
+            return
+
+        self._publish(slot, None)
+        if failed:
+            self._failed_endpoints[slot] = conn.endpoint
+        try:
+            conn.grpc_channel.close()
+        except Exception:
+            _log.exception('Failed to close Etcd client gRPC channel')
+
+    def _publish(self, slot, conn):
+        """
+        Replaces the connection of a pool member in a new snapshot.
+        """
+        with self._mu:
+            conns = list(self._conns)
+            conns[slot] = conn
+            self._conns = tuple(conns)
+
+
+def is_transport_error(err):
+    """
+    Tells if the error means that the connection it occurred on is broken.
+    """
+    return (isinstance(err, grpc.RpcError) and
+            err.code() == grpc.StatusCode.UNAVAILABLE)
@@ -1,27 +1,70 @@
 import logging
+import os
+import queue
+import weakref
+from collections import deque
 from enum import Enum
-from random import shuffle
-from threading import Lock
+from random import sample, shuffle
+from threading import Condition, Lock, Thread
+from time import sleep, time
 
 import grpc
 
 from etcd3 import _utils
+from etcd3._channel_pool import GrpcChannelPool, GrpcConn
+from etcd3._dispatcher import Backpressure, EventDispatcher
+from etcd3._endpoint_refresher import EndpointRefresher
+from etcd3._hedging import LatencyPercentile
 from etcd3._keep_aliver import KeepAliver
-from etcd3._protobuf.rpc_pb2 import (AuthenticateRequest, DeleteRangeRequest,
-                                     LeaseGrantRequest, LeaseRevokeRequest,
-                                     MemberListRequest, PutRequest,
+from etcd3._mirror import PrefixMirror
+from etcd3._put_batcher import PutBatcher
+from etcd3._retry import RetryPolicy
+from etcd3._single_flight import SingleFlight
+from etcd3._token_auth import TokenAuth, authenticate, is_token_expired
+from etcd3._watch_mux import MuxWatcher, WatchMux
+from etcd3._protobuf.rpc_pb2 import (AuthenticateRequest, LeaseGrantRequest,
+                                     LeaseRevokeRequest, MemberListRequest,
                                      RangeRequest)
-from etcd3._protobuf.rpc_pb2_grpc import (AuthStub, ClusterStub, LeaseStub,
-                                          WatchStub, KVStub)
+from etcd3._txn import (Txn, TxnChunkResult, chunk_ops, dedup_ops,
+                        new_delete_op, new_delete_rq, new_put_op, new_put_rq,
+                        new_range_op, new_range_rq)
 from etcd3._watcher import Watcher
 
 _DEFAULT_ETCD_ENDPOINT = '127.0.0.1:2379'
 # It was observed in production that during failovers timeouts are getting
 # really high. Thundering herd of reconnections is probably at play here.
 _DEFAULT_REQUEST_TIMEOUT = 30  # Seconds
+_DEFAULT_PAGE_SIZE = 1000
+_DEFAULT_DISCOVERY_INTERVAL = 60  # Seconds
+# Default of Etcd --auth-token-ttl.
+_DEFAULT_TOKEN_TTL = 300  # Seconds
+# Etcd rejects transactions with more than 128 operations by default, see
+# --max-txn-ops, and requests bigger than 1.5MiB, see --max-request-bytes.
+_DEFAULT_MAX_TXN_OPS = 128
+_DEFAULT_MAX_TXN_BYTES = 1024 * 1024
+_DEFAULT_MAX_IN_FLIGHT = 8
+_DEFAULT_PUT_BATCH_WINDOW = 0.01  # Seconds
+_DEFAULT_DISPATCH_WORKERS = 4
+_DEFAULT_DISPATCH_LANE_SIZE = 1024
+# Endpoint latency is tracked as an exponentially weighted moving average
+# with this weight given to the latest sample. Error rate is tracked the same
+# way, but also halves every _ERROR_HALF_LIFE so that a recovered endpoint is
+# not avoided forever.
+_EWMA_WEIGHT = 0.2
+_ERROR_HALF_LIFE = 10  # Seconds
+_ERROR_PENALTY = 10
+_MIN_LATENCY = 0.001  # Seconds
+# Errors that count against the endpoint that a call was made to, rather
+# than against the call itself.
+_ENDPOINT_ERROR_CODES = frozenset([grpc.StatusCode.UNAVAILABLE,
+                                   grpc.StatusCode.DEADLINE_EXCEEDED,
+                                   grpc.StatusCode.RESOURCE_EXHAUSTED])
 
 _log = logging.getLogger(__name__)
 
+# Clients of the process, that are reset in a child process after fork.
+_clients = weakref.WeakSet()
+
 
 class SortOrder(Enum):
     NONE = 0
@@ -38,70 +81,449 @@ class SortTarget(Enum):
 
 
 def _reconnect(f):
-
-    def wrapper(*args, **kwargs):
-        etcd3_clt = args[0]
+    """
+    Makes the decorated method retry on gRPC errors as far as the client retry
+    policy allows. Errors are reported to the channel pool, that replaces the
+    connection only if it is broken. All attempts share one deadline that is
+    the client timeout away from the first attempt, unless it is given by
+    the `_deadline` keyword argument. The decorated method is given the
+    connection to make a call with, and the timeout of the attempt, as the
+    first arguments after self.
+    """
+    def wrapper(etcd3_clt, *args, **kwargs):
         assert isinstance(etcd3_clt, Client)
-        etcd3_clt._ensure_grpc_channel()
-        try:
+        grpc_pool = etcd3_clt._grpc_pool
+        balancer = etcd3_clt._endpoint_balancer
+        deadline = kwargs.pop('_deadline', None)
+        if deadline is None:
+            deadline = time() + etcd3_clt._timeout
+        attempt = 1
+        while True:
+            conn = None
+            token = etcd3_clt._token_auth and etcd3_clt._token_auth.token
+            started_at = time()
             try:
-                return f(*args, **kwargs)
+                conn = grpc_pool.acquire()
+                rs = f(etcd3_clt, conn, deadline - started_at, *args, **kwargs)
+                balancer.observe(conn.endpoint, time() - started_at)
+                grpc_pool.report(conn)
+                return rs
+
+            except ValueError:
+                # Raised by gRPC if the channel has been closed by another
+                # thread since it was acquired, a new one is acquired then.
+                if not conn or not grpc_pool.is_closed(conn):
+                    raise
+
+                continue
 
             except grpc.RpcError as err:
-                severity = logging.ERROR
-                if (err.code() == grpc.StatusCode.UNAUTHENTICATED and
-                        err.details().endswith('invalid auth token')):
-                    severity = logging.WARN
+                if conn:
+                    balancer.observe(conn.endpoint, time() - started_at, err)
+                    grpc_pool.report(conn, err)
 
-                _log.log(severity, 'Retrying error: %s(*%s, **%s)',
-                         f, args, kwargs, exc_info=True)
-                etcd3_clt._reset_grpc_channel()
-                return f(*args, **kwargs)
+                if is_token_expired(err):
+                    etcd3_clt._renew_token(token)
 
-        except Exception:
-            etcd3_clt._close_grpc_channel()
-            raise
+                delay = etcd3_clt._retry_policy.next_delay(
+                    attempt, err, deadline - time())
+                if delay is None:
+                    raise
+
+                _log_retry(err, delay, f, args, kwargs)
+
+            finally:
+                if conn:
+                    grpc_pool.release(conn)
+
+            sleep(delay)
+            attempt += 1
+
+    return wrapper
+
+
+def _reconnect_future(f):
+    """
+    Counterpart of `_reconnect` for methods that return gRPC futures. The
+    future returned by the decorated method is wrapped into a
+    `_ReconnectingFuture` that retries the call the same way on gRPC error.
+    """
+    def wrapper(etcd3_clt, *args, **kwargs):
+        assert isinstance(etcd3_clt, Client)
+        return _ReconnectingFuture(etcd3_clt, f, args, kwargs)
 
     return wrapper
 
 
+def _log_retry(err, delay, f, args, kwargs):
+    severity = logging.ERROR
+    if is_token_expired(err):
+        severity = logging.WARN
+
+    _log.log(severity, 'Retrying error in %.3fs: %s(*%s, **%s)',
+             delay, f, args, kwargs, exc_info=err)
+
+
+class _ReconnectingFuture(grpc.Future):
+    """
+    Future of a gRPC call that behaves like `_reconnect`: if the call fails
+    with a gRPC error, then the call is retried as the client retry policy
+    allows. The future is resolved, and done callbacks are invoked, only when
+    the call succeeds or is given up on. Retries are made by a short lived
+    thread, for a failed connection cannot be reported to the pool from a
+    gRPC callback.
+    """
+
+    def __init__(self, client, f, args, kwargs):
+        self._client = client
+        self._f = f
+        self._args = args
+        self._kwargs = kwargs
+        self._cond = Condition()
+        self._deadline = time() + client._timeout
+        self._attempt = 1
+        self._conn = None
+        self._token = None
+        self._future = None
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._start()
+
+    def cancel(self):
+        with self._cond:
+            if self._done:
+                return False
+
+            future = self._future
+
+        if future:
+            future.cancel()
+
+        return self._resolve(cancelled=True)
+
+    def cancelled(self):
+        return self._cancelled
+
+    def running(self):
+        return not self._done
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        err = self.exception(timeout)
+        if err:
+            raise err
+
+        return self._result
+
+    def exception(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._done, timeout):
+                raise grpc.FutureTimeoutError()
+
+        if self._cancelled:
+            raise grpc.FutureCancelledError()
+
+        return self._exception
+
+    def traceback(self, timeout=None):
+        err = self.exception(timeout)
+        return err and err.__traceback__
+
+    def add_done_callback(self, fn):
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def _start(self):
+        with self._cond:
+            if self._done:
+                return
+
+            self._future = future = self._call()
+
+        future.add_done_callback(self._on_attempt_done)
+
+    def _on_attempt_done(self, future):
+        if future.cancelled():
+            return
+
+        err = future.exception()
+        if not err:
+            self._resolve(result=future.result())
+            return
+
+        if not isinstance(err, grpc.RpcError):
+            self._resolve(exception=err)
+            return
+
+        retrier = Thread(name='etcd3_retry', target=self._retry, args=(err,))
+        retrier.daemon = True
+        retrier.start()
+
+    def _retry(self, err):
+        """
+        Starts another attempt of the call if the retry policy allows that,
+        otherwise resolves the future with the error.
+        """
+        self._client._grpc_pool.report(self._conn, err)
+        if is_token_expired(err):
+            self._client._renew_token(self._token)
+
+        while True:
+            delay = self._client._retry_policy.next_delay(
+                self._attempt, err, self._deadline - time())
+            if delay is None:
+                self._resolve(exception=err)
+                return
+
+            _log_retry(err, delay, self._f, self._args, self._kwargs)
+            sleep(delay)
+            self._attempt += 1
+            try:
+                self._start()
+                return
+
+            except grpc.RpcError as call_err:
+                err = call_err
+
+            except Exception as call_err:
+                self._resolve(exception=call_err)
+                return
+
+    def _resolve(self, result=None, exception=None, cancelled=False):
+        """
+        Completes the future unless it is already. Returns False if it is.
+        """
+        with self._cond:
+            if self._done:
+                return False
+
+            self._done = True
+            self._cancelled = cancelled
+            self._result = result
+            self._exception = exception
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notify_all()
+
+        for fn in callbacks:
+            try:
+                fn(self)
+
+            except Exception:
+                _log.exception('Future done callback failed')
+
+        return True
+
+    def _call(self):
+        grpc_pool = self._client._grpc_pool
+        token_auth = self._client._token_auth
+        self._token = token_auth and token_auth.token
+        while True:
+            conn = grpc_pool.acquire()
+            started_at = time()
+            try:
+                future = self._f(self._client, conn,
+                                 self._deadline - started_at,
+                                 *self._args, **self._kwargs)
+                break
+
+            except ValueError:
+                grpc_pool.release(conn)
+                # See `_reconnect`.
+                if not grpc_pool.is_closed(conn):
+                    raise
+
+            except Exception:
+                grpc_pool.release(conn)
+                raise
+
+        self._conn = conn
+        future.add_done_callback(_new_call_tracker(self._client, conn,
+                                                   started_at))
+        return future
+
+
+def _get_done(done_futures, deadline):
+    """
+    Returns the next completed future from the queue, or None if there is
+    none by the deadline.
+    """
+    try:
+        return done_futures.get(timeout=max(deadline - time(), 0))
+
+    except queue.Empty:
+        return None
+
+
+def _new_call_tracker(client, conn, started_at):
+    """
+    Returns a done callback for a gRPC future of a call made over the pooled
+    connection. The callback gives the connection back to the pool and
+    records the call latency. Errors are supposed to be reported to the pool
+    by the thread that collects the result, for a channel cannot be closed
+    from its own callback.
+    """
+    def on_done(done_future):
+        client._grpc_pool.release(conn)
+        if done_future.cancelled():
+            return
+
+        err = done_future.exception()
+        client._endpoint_balancer.observe(conn.endpoint, time() - started_at,
+                                          err)
+        if not err:
+            client._grpc_pool.report(conn)
+
+    return on_done
+
+
 class Client(object):
 
     def __init__(self, endpoints=None, user=None, password=None, timeout=None,
-                 cert=None, cert_key=None, cert_ca=None, with_tls=False):
+                 cert=None, cert_key=None, cert_ca=None, with_tls=False,
+                 coalesce_reads=False, channel_pool_size=1,
+                 balance_by_latency=False, retry_policy=None,
+                 hedge_percentile=None, discovery_interval=None,
+                 token_ttl=None, multiplex_watches=False):
+        """
+        `timeout` is the number of seconds a call is given to complete,
+        including all of its retries. Retries are made as `retry_policy`
+        allows, by default a `RetryPolicy` with default parameters.
+
+        If `coalesce_reads` is True, then concurrent `get` calls with
+        identical arguments share one request to Etcd and all receive its
+        response. Shared responses must not be modified by callers.
+
+        `channel_pool_size` is the number of gRPC channels, hence HTTP/2
+        connections, that calls and streams of the client are spread across.
+
+        If `balance_by_latency` is True, then endpoints to connect to are
+        chosen by their observed latency and error rate rather than in turn,
+        and calls are given the pooled channel with the lowest latency
+        weighted by the number of calls in flight.
+
+        If `hedge_percentile` is given, e.g. 0.95, then a serializable `get`
+        that has not completed within that percentile of recent serializable
+        read latencies of the member it is sent to, is sent again to another
+        member, and whichever
+        response comes first is returned. The request is hedged over a pooled
+        channel connected to another member, so `channel_pool_size` has to be
+        greater than 1 for that.
+
+        Cluster members are discovered in the background every
+        `discovery_interval` seconds, and sooner when a connection fails.
+
+        The auth token is shared by all channels and renewed in the background
+        well before `token_ttl` seconds pass, that should match the
+        --auth-token-ttl of the cluster.
+
+        If `multiplex_watches` is True, then watchers share Watch streams, one
+        per pooled channel, instead of running a stream and two threads each.
+        Handlers of watchers sharing a stream are called on one thread. That
+        requires Etcd 3.4+.
+
+        A client can be used after fork. In the child process gRPC channels
+        and background threads of the parent are dropped and created anew on
+        first use, while the discovered endpoints and the auth token are
+        kept. Watchers and keep-alivers are left to the parent, they are not
+        resumed in the child.
+        """
         endpoints = endpoints or _DEFAULT_ETCD_ENDPOINT
-        self._endpoint_balancer = _EndpointBalancer(endpoints)
+        self._endpoint_balancer = _EndpointBalancer(endpoints,
+                                                    balance_by_latency,
+                                                    hedge_percentile)
         self._tls_creds = _new_tls_creds(cert, cert_key, cert_ca, with_tls)
         self._auth_rq = _new_auth_rq(user, password)
         if self._auth_rq and not self._tls_creds:
             raise AttributeError('Authentication is only allowed via TLS')
 
+        self._token_auth = None
+        if self._auth_rq:
+            self._token_auth = TokenAuth(self, self._auth_rq,
+                                         token_ttl or _DEFAULT_TOKEN_TTL)
+
         self._timeout = timeout or _DEFAULT_REQUEST_TIMEOUT
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._read_flights = SingleFlight() if coalesce_reads else None
+        self._hedge_reads = bool(hedge_percentile)
+
+        endpoint_cost = None
+        if balance_by_latency:
+            endpoint_cost = self._endpoint_balancer.score
+
+        self._grpc_pool = GrpcChannelPool(channel_pool_size, self._connect,
+                                          endpoint_cost)
 
-        self._grpc_channel_mu = Lock()
-        self._grpc_channel = None
-        self._kv_stub = None
-        self._watch_stub = None
-        self._lease_stub = None
+        self._endpoint_refresher = EndpointRefresher(
+            self, discovery_interval or _DEFAULT_DISCOVERY_INTERVAL)
+
+        self._watch_muxes = None
+        if multiplex_watches:
+            self._watch_muxes = [WatchMux(self, 'watch_mux_%d' % (i,))
+                                 for i in range(channel_pool_size)]
 
         # For tests only!
         self._skip_endpoint_discovery = False
 
+        _clients.add(self)
+
     @property
     def current_endpoint(self):
         return self._endpoint_balancer.current_endpoint
 
-    @_reconnect
     def get(self, key, is_prefix=False, limit=0,
-            sort_order=SortOrder.NONE, sort_target=SortTarget.KEY):
-        rq = RangeRequest(key=_utils.to_bytes(key),
-                          limit=limit,
-                          sort_order=sort_order.value,
-                          sort_target=sort_target.value)
-        if is_prefix:
-            rq.range_end = _utils.range_end(rq.key)
-
-        return self._kv_stub.Range(rq, timeout=self._timeout)
+            sort_order=SortOrder.NONE, sort_target=SortTarget.KEY,
+            keys_only=False, count_only=False, serializable=False,
+            revision=0, min_mod_revision=0, max_mod_revision=0,
+            min_create_revision=0, max_create_revision=0):
+        """
+        Reads a key, or all keys with the given prefix if `is_prefix` is True.
+
+        If `keys_only` is True then values are not returned, and if
+        `count_only` is True then only the number of keys is. A
+        `serializable` read is served by any member from its local state,
+        that may be stale, without a round trip to the leader. A non zero
+        `revision` reads keys as of that revision, and `min/max_*_revision`
+        filter keys by their modification and creation revisions.
+        """
+        rq = new_range_rq(key, is_prefix, limit,
+                          sort_order.value, sort_target.value,
+                          keys_only=keys_only,
+                          count_only=count_only,
+                          serializable=serializable,
+                          revision=revision,
+                          min_mod_revision=min_mod_revision,
+                          max_mod_revision=max_mod_revision,
+                          min_create_revision=min_create_revision,
+                          max_create_revision=max_create_revision)
+        range_f = self._range
+        if serializable and self._hedge_reads:
+            range_f = self._range_hedged
+
+        if self._read_flights:
+            return self._read_flights.do(rq.SerializeToString(),
+                                         lambda: range_f(rq))
+
+        return range_f(rq)
+
+    def get_async(self, key, is_prefix=False, limit=0,
+                  sort_order=SortOrder.NONE, sort_target=SortTarget.KEY,
+                  **kwargs):
+        """
+        Non-blocking variant of `get`. It accepts the same arguments and
+        returns a future of `get` result.
+        """
+        rq = new_range_rq(key, is_prefix, limit,
+                          sort_order.value, sort_target.value, **kwargs)
+        return self._range_async(rq)
 
     def get_value(self, key):
         """
@@ -114,126 +536,529 @@ class Client(object):
 
         return rs.kvs[0].value
 
-    @_reconnect
+    def count(self, prefix, serializable=False):
+        """
+        Returns the number of keys with the given prefix without fetching them.
+        """
+        rs = self.get(prefix, is_prefix=True, count_only=True,
+                      serializable=serializable)
+        return rs.count
+
+    def keys(self, prefix, serializable=False):
+        """
+        Returns a list of keys with the given prefix without their values.
+        """
+        rs = self.get(prefix, is_prefix=True, keys_only=True,
+                      serializable=serializable)
+        return [kv.key for kv in rs.kvs]
+
+    def get_many(self, keys, max_txn_ops=_DEFAULT_MAX_TXN_OPS):
+        """
+        Reads many keys at once and returns a dict of their values, where a
+        value is None if the respective key does not exist. Keys are read in
+        one transaction, or if there are more than `max_txn_ops` of them in
+        several concurrent ones. Either way all values are read at the same
+        revision.
+        """
+        keyed_ops = [(key, new_range_op(key)) for key in keys]
+        chunks = list(chunk_ops(keyed_ops, max_txn_ops,
+                                _DEFAULT_MAX_TXN_BYTES))
+        if not chunks:
+            return {}
+
+        first_keys, first_rq = chunks[0]
+        results = [TxnChunkResult(first_keys, self._txn(first_rq), None)]
+        if len(chunks) > 1:
+            # Pin the remaining reads to the revision of the first one.
+            revision = results[0].response.header.revision
+            for _, rq in chunks[1:]:
+                for op in rq.success:
+                    op.request_range.revision = revision
+
+            results.extend(self._commit_chunks(chunks[1:],
+                                               _DEFAULT_MAX_IN_FLIGHT))
+        values = {}
+        for result in results:
+            if result.error:
+                raise result.error
+
+            for key, op_rs in zip(result.keys, result.response.responses):
+                kvs = op_rs.response_range.kvs
+                values[key] = kvs[0].value if kvs else None
+
+        return values
+
+    def iter_prefix(self, key, page_size=_DEFAULT_PAGE_SIZE, revision=0,
+                    read_ahead=False):
+        """
+        Generator that yields all key-values with the given prefix, fetching
+        them from Etcd in pages of `page_size` items. All pages are read at
+        the same revision, that is either the one specified or the revision of
+        the first page, so the result is a consistent snapshot of the prefix.
+
+        If `read_ahead` is True, then the next page is requested while the
+        caller consumes the current one.
+        """
+        rq = RangeRequest(key=_utils.to_bytes(key),
+                          limit=page_size,
+                          revision=revision)
+        rq.range_end = _utils.range_end(rq.key)
+
+        rs = self._range(rq)
+        rq.revision = rs.header.revision
+        while True:
+            next_rs_future = None
+            if rs.more:
+                rq.key = rs.kvs[-1].key + b'\0'
+                if read_ahead:
+                    next_rs_future = self._range_async(rq)
+
+            for kv in rs.kvs:
+                yield kv
+
+            if not rs.more:
+                return
+
+            if next_rs_future:
+                rs = next_rs_future.result()
+            else:
+                rs = self._range(rq)
+
     def put(self, key, val, lease_id=None):
-        rq = PutRequest(key=_utils.to_bytes(key),
-                        value=_utils.to_bytes(val),
-                        lease=lease_id)
-        return self._kv_stub.Put(rq, timeout=self._timeout)
+        return self._put(new_put_rq(key, val, lease_id))
+
+    def put_async(self, key, val, lease_id=None):
+        """
+        Non-blocking variant of `put`, returns a future of its result.
+        """
+        return self._put_async(new_put_rq(key, val, lease_id))
 
-    @_reconnect
     def delete(self, key, is_prefix=False):
-        rq = DeleteRangeRequest(key=_utils.to_bytes(key))
-        if is_prefix:
-            rq.range_end = _utils.range_end(rq.key)
+        return self._delete_range(new_delete_rq(key, is_prefix))
+
+    def delete_async(self, key, is_prefix=False):
+        """
+        Non-blocking variant of `delete`, returns a future of its result.
+        """
+        return self._delete_range_async(new_delete_rq(key, is_prefix))
 
-        return self._kv_stub.DeleteRange(rq, timeout=self._timeout)
+    def put_many(self, items, lease_id=None, max_txn_ops=_DEFAULT_MAX_TXN_OPS,
+                 max_txn_bytes=_DEFAULT_MAX_TXN_BYTES,
+                 max_in_flight=_DEFAULT_MAX_IN_FLIGHT):
+        """
+        Stores many key-values packing them into transactions that respect
+        `max_txn_ops` and `max_txn_bytes` limits. Up to `max_in_flight`
+        transactions are sent concurrently. `items` is either a dict or an
+        iterable of key-value pairs. If a key is given more than once, then
+        the last value wins.
+
+        Returns a list of `TxnChunkResult`, one per transaction in the order
+        the items were given. A failed transaction does not stop the others
+        and is reported via the `error` field of its result.
+        """
+        if isinstance(items, dict):
+            items = items.items()
+
+        keyed_ops = ((key, new_put_op(key, val, lease_id))
+                     for key, val in items)
+        chunks = chunk_ops(dedup_ops(keyed_ops), max_txn_ops, max_txn_bytes)
+        return self._commit_chunks(chunks, max_in_flight)
+
+    def delete_many(self, keys, is_prefix=False,
+                    max_txn_ops=_DEFAULT_MAX_TXN_OPS,
+                    max_txn_bytes=_DEFAULT_MAX_TXN_BYTES,
+                    max_in_flight=_DEFAULT_MAX_IN_FLIGHT):
+        """
+        Deletes many keys (or prefixes if `is_prefix` is True) the same way
+        `put_many` stores them.
+        """
+        keyed_ops = ((key, new_delete_op(key, is_prefix)) for key in keys)
+        chunks = chunk_ops(dedup_ops(keyed_ops), max_txn_ops, max_txn_bytes)
+        return self._commit_chunks(chunks, max_in_flight)
+
+    def txn(self):
+        """
+        Returns a transaction builder, see `Txn` for details.
+        """
+        return Txn(self)
 
-    @_reconnect
     def lease_grant(self, ttl):
-        rq = LeaseGrantRequest(TTL=ttl)
-        return self._lease_stub.LeaseGrant(rq, timeout=self._timeout)
+        return self._lease_grant(LeaseGrantRequest(TTL=ttl))
+
+    def lease_grant_async(self, ttl):
+        """
+        Non-blocking variant of `lease_grant`, returns a future of its result.
+        """
+        return self._lease_grant_async(LeaseGrantRequest(TTL=ttl))
 
-    @_reconnect
     def lease_revoke(self, lease_id):
-        rq = LeaseRevokeRequest(ID=lease_id)
-        return self._lease_stub.LeaseRevoke(rq, timeout=self._timeout)
+        return self._lease_revoke(LeaseRevokeRequest(ID=lease_id))
+
+    def lease_revoke_async(self, lease_id):
+        """
+        Non-blocking variant of `lease_revoke`, returns a future of its result.
+        """
+        return self._lease_revoke_async(LeaseRevokeRequest(ID=lease_id))
 
     def new_watcher(self, key, event_handler, is_prefix=False,
-                    start_revision=0, spin_pause=None):
-        return Watcher(
-            self, key, event_handler, is_prefix, start_revision, spin_pause)
+                    start_revision=0, spin_pause=None, compacted_handler=None,
+                    batch_events=False, filters=None, prev_kv=False,
+                    progress_notify=False, fragment=False,
+                    resync_handler=None, dispatcher=None,
+                    progress_handler=None):
+        """
+        Returns a watcher that calls `event_handler` with every event of the
+        key, or of all keys with the given prefix if `is_prefix` is True. If
+        `batch_events` is True, then the handler is called with all events
+        of a watch response at once and the response header revision, e.g.
+        all changes made by a transaction, so that they can be applied in
+        bulk. The header revision can be past the last event, e.g. when Etcd
+        catches up a lagging watch in parts, hence it does not tell that all
+        events up to it have been received.
+
+        `filters` is a list of `WatchFilter` values telling Etcd not to send
+        events of that type. If `prev_kv` is True, then events carry the
+        key-value as it was before the event. If `progress_notify` is True,
+        then Etcd periodically notifies a watch with no events of its
+        current revision, so that the watch resumes from there if the stream
+        fails, and `progress_handler` is called with that revision, for all
+        events up to it have been received. If `fragment` is True, then Etcd
+        may split large responses, they are joined together before the
+        events are handled.
+
+        If the revision to resume watching from has been compacted, then
+        events before the compact revision are lost. `compacted_handler` is
+        called with the compact revision and returns the revision to resume
+        from. Alternatively `resync_handler` is called with a list of current
+        KeyValues of the watched keys and the revision they were read at, so
+        that the application can reload its state, and watching resumes past
+        that revision. When Etcd cancels a watch for another reason, e.g.
+        lost permissions, then the watch is created again after
+        `spin_pause`, and `resync_handler` is called likewise, so that the
+        application learns about it.
+
+        If `dispatcher`, one returned by `new_event_dispatcher`, is given,
+        then the handler is called on the dispatcher workers, so that a slow
+        handler does not hold up the watch stream. Events are considered
+        seen once they are queued, hence a watch does not replay events
+        that the dispatcher drops. Stopping the watcher waits for its queued
+        events to be handled, and so does calling the compacted and resync
+        handlers.
+        """
+        if self._watch_muxes:
+            mux = min(self._watch_muxes, key=lambda m: m.size)
+            return MuxWatcher(mux, key, event_handler, is_prefix,
+                              start_revision, spin_pause, compacted_handler,
+                              batch_events, filters, prev_kv,
+                              progress_notify, fragment, resync_handler,
+                              dispatcher, progress_handler)
+
+        return Watcher(self, key, event_handler, is_prefix, start_revision,
+                       spin_pause, compacted_handler, batch_events, filters,
+                       prev_kv, progress_notify, fragment, resync_handler,
+                       dispatcher, progress_handler)
+
+    def new_event_dispatcher(self, workers=_DEFAULT_DISPATCH_WORKERS,
+                             lane_size=_DEFAULT_DISPATCH_LANE_SIZE,
+                             backpressure=Backpressure.BLOCK):
+        """
+        Returns a dispatcher that runs event handlers of the watchers it is
+        given to on `workers` threads, preserving the order of events of
+        each key. See `etcd3._dispatcher.EventDispatcher` for details.
+        """
+        return EventDispatcher('event_dispatcher', workers, lane_size,
+                               backpressure)
 
     def new_keep_aliver(self, key, value, ttl, spin_pause=None):
         return KeepAliver(self, key, value, ttl, spin_pause)
 
+    def new_prefix_mirror(self, prefix, spin_pause=None):
+        return PrefixMirror(self, prefix, spin_pause)
+
+    def new_put_batcher(self, window=_DEFAULT_PUT_BATCH_WINDOW,
+                        max_txn_ops=_DEFAULT_MAX_TXN_OPS):
+        return PutBatcher(self, window, max_txn_ops, _DEFAULT_MAX_TXN_BYTES,
+                          _DEFAULT_MAX_IN_FLIGHT)
+
+    def close(self, timeout=None):
+        """
+        Stops the background endpoint discovery and auth token renewal, and
+        closes gRPC channels of the client. Watchers, keep-alivers and put
+        batchers of the client should be stopped before. Returns False if
+        the background threads are still running after `timeout` seconds.
+        """
+        deadline = None if timeout is None else time() + timeout
+        stopped = self._endpoint_refresher.stop(timeout)
+        if self._token_auth:
+            if deadline is not None:
+                timeout = max(deadline - time(), 0)
+
+            stopped = self._token_auth.stop(timeout) and stopped
+
+        self._grpc_pool.close_all()
+        return stopped
+
     @_reconnect
-    def _get_watch_stub(self):
-        return self._watch_stub
+    def _range(self, conn, timeout, rq):
+        return conn.kv_stub.Range(rq, timeout=timeout)
+
+    @_reconnect_future
+    def _range_async(self, conn, timeout, rq):
+        return conn.kv_stub.Range.future(rq, timeout=timeout)
 
     @_reconnect
-    def _get_lease_stub(self):
-        return self._lease_stub
+    def _authenticate(self, conn, timeout, rq):
+        return authenticate(conn.auth_stub, rq, timeout)
 
-    def _ensure_grpc_channel(self):
-        with self._grpc_channel_mu:
-            if self._grpc_channel:
-                return
+    @_reconnect
+    def _member_list(self, conn, timeout, rq):
+        return conn.cluster_stub.MemberList(rq, timeout=timeout)
 
-            self._ensure_grpc_channel_unsafe()
+    def _range_hedged(self, rq):
+        """
+        Sends the range request, and if it has not completed within the hedge
+        delay of the member it is sent to, sends it again over a channel to
+        another member. Returns the response that comes first. If no attempt
+        succeeds, then the request is made the usual way with retries. All
+        attempts share one deadline that is the client timeout away.
+        """
+        deadline = time() + self._timeout
+        done_futures = queue.Queue()
+        started_at = time()
+        try:
+            conn = self._grpc_pool.acquire()
+            rs_future = self._start_range(conn, rq, deadline)
 
-    def _close_grpc_channel(self):
-        with self._grpc_channel_mu:
-            self._close_grpc_channel_unsafe()
+        except (grpc.RpcError, ValueError):
+            return self._range(rq, _deadline=deadline)
 
-    def _reset_grpc_channel(self):
-        with self._grpc_channel_mu:
-            self._close_grpc_channel_unsafe()
-            self._ensure_grpc_channel_unsafe()
+        hedge_delay = self._endpoint_balancer.hedge_delay(conn.endpoint)
 
-    def _ensure_grpc_channel_unsafe(self):
-        endpoint = self._endpoint_balancer.rotate_endpoint()
-        self._grpc_channel = self._dial(endpoint)
+        def on_done(done_future):
+            if not done_future.exception():
+                hedge_delay.observe(time() - started_at)
 
-        if not self._skip_endpoint_discovery:
-            cluster_stub = ClusterStub(self._grpc_channel)
-            rs = cluster_stub.MemberList(MemberListRequest(),
-                                         timeout=self._timeout)
-            self._endpoint_balancer.refresh(rs.members, endpoint)
+            done_futures.put(done_future)
+
+        rs_future.add_done_callback(on_done)
+        attempts = [(conn, rs_future)]
+        try:
+            done_future = done_futures.get(
+                timeout=max(min(hedge_delay.value, deadline - time()), 0))
 
-        self._kv_stub = KVStub(self._grpc_channel)
-        self._watch_stub = WatchStub(self._grpc_channel)
-        self._lease_stub = LeaseStub(self._grpc_channel)
+        except queue.Empty:
+            hedge_conn = self._grpc_pool.acquire_other(conn.endpoint)
+            if hedge_conn:
+                _log.debug('Hedging range request: %s, delay=%.3fs',
+                           rq.key, hedge_delay.value)
+                try:
+                    hedge_future = self._start_range(hedge_conn, rq, deadline)
+                    hedge_future.add_done_callback(done_futures.put)
+                    attempts.append((hedge_conn, hedge_future))
 
-    def _close_grpc_channel_unsafe(self):
-        if not self._grpc_channel:
-            return
+                except (grpc.RpcError, ValueError):
+                    pass
+
+            done_future = _get_done(done_futures, deadline)
+
+        failed = 0
+        while done_future:
+            if not done_future.exception():
+                # The first attempt is let to complete even if it is late, to
+                # keep recording its latency unbiased.
+                for _, rs_future in attempts[1:]:
+                    rs_future.cancel()
+
+                return done_future.result()
+
+            failed += 1
+            if failed == len(attempts):
+                break
+
+            done_future = _get_done(done_futures, deadline)
+
+        for conn, rs_future in attempts:
+            if rs_future.done():
+                self._grpc_pool.report(conn, rs_future.exception())
+            else:
+                rs_future.cancel()
+
+        return self._range(rq, _deadline=deadline)
+
+    def _start_range(self, conn, rq, deadline):
+        """
+        Starts a range call over an acquired connection, that is released
+        when the call completes.
+        """
+        started_at = time()
         try:
-            self._grpc_channel.close()
+            rs_future = conn.kv_stub.Range.future(
+                rq, timeout=max(deadline - started_at, 0))
+
         except Exception:
-            _log.exception('Failed to close Etcd client gRPC channel')
+            self._grpc_pool.release(conn)
+            raise
+
+        rs_future.add_done_callback(_new_call_tracker(self, conn, started_at))
+        return rs_future
+
+    @_reconnect
+    def _put(self, conn, timeout, rq):
+        return conn.kv_stub.Put(rq, timeout=timeout)
+
+    @_reconnect_future
+    def _put_async(self, conn, timeout, rq):
+        return conn.kv_stub.Put.future(rq, timeout=timeout)
+
+    @_reconnect
+    def _delete_range(self, conn, timeout, rq):
+        return conn.kv_stub.DeleteRange(rq, timeout=timeout)
+
+    @_reconnect_future
+    def _delete_range_async(self, conn, timeout, rq):
+        return conn.kv_stub.DeleteRange.future(rq, timeout=timeout)
+
+    @_reconnect
+    def _txn(self, conn, timeout, rq):
+        return conn.kv_stub.Txn(rq, timeout=timeout)
+
+    @_reconnect_future
+    def _txn_async(self, conn, timeout, rq):
+        return conn.kv_stub.Txn.future(rq, timeout=timeout)
+
+    @_reconnect
+    def _lease_grant(self, conn, timeout, rq):
+        return conn.lease_stub.LeaseGrant(rq, timeout=timeout)
+
+    @_reconnect_future
+    def _lease_grant_async(self, conn, timeout, rq):
+        return conn.lease_stub.LeaseGrant.future(rq, timeout=timeout)
+
+    @_reconnect
+    def _lease_revoke(self, conn, timeout, rq):
+        return conn.lease_stub.LeaseRevoke(rq, timeout=timeout)
+
+    @_reconnect_future
+    def _lease_revoke_async(self, conn, timeout, rq):
+        return conn.lease_stub.LeaseRevoke.future(rq, timeout=timeout)
+
+    def _commit_chunks(self, chunks, max_in_flight):
+        results = []
+        in_flight = deque()
+        for keys, rq in chunks:
+            if len(in_flight) >= max_in_flight:
+                results.append(self._await_chunk(*in_flight.popleft()))
+
+            try:
+                rs_future = self._txn_async(rq)
+
+            except Exception as err:
+                rs_future = err
+
+            in_flight.append((keys, rs_future))
+
+        while in_flight:
+            results.append(self._await_chunk(*in_flight.popleft()))
+
+        return results
+
+    def _await_chunk(self, keys, rs_future):
+        if isinstance(rs_future, Exception):
+            return TxnChunkResult(keys, None, rs_future)
+        try:
+            return TxnChunkResult(keys, rs_future.result(), None)
 
-        self._grpc_channel = None
+        except Exception as err:
+            return TxnChunkResult(keys, None, err)
+
+    def _acquire_stream_conn(self):
+        """
+        Returns a connection to open a stream with. It must be given back via
+        `_release_stream_conn` once the stream is closed, along with the error
+        that the stream failed with if any.
+        """
+        return self._grpc_pool.acquire_stream()
+
+    def _release_stream_conn(self, conn, err=None):
+        self._grpc_pool.release_stream(conn)
+        if err:
+            self._grpc_pool.report(conn, err)
+
+    def _connect(self, slot, failed_endpoint=None):
+        endpoint = self._endpoint_balancer.rotate_endpoint()
+        if endpoint == failed_endpoint:
+            endpoint = self._endpoint_balancer.rotate_endpoint()
+
+        grpc_channel = self._dial(endpoint)
+
+        if not self._skip_endpoint_discovery:
+            self._endpoint_refresher.start()
+            if failed_endpoint:
+                self._endpoint_refresher.hint()
+
+        return GrpcConn(slot, endpoint, grpc_channel)
+
+    def _discover_endpoints(self):
+        """
+        Fetches the cluster membership and updates the endpoint list with it.
+        """
+        rs = self._member_list(MemberListRequest())
+        balancer = self._endpoint_balancer
+        balancer.refresh(rs.members, balancer.current_endpoint)
 
     def _dial(self, endpoint):
         if not self._tls_creds:
             return grpc.insecure_channel(endpoint)
 
-        creds = self._tls_creds
+        if not self._token_auth:
+            return grpc.secure_channel(endpoint, self._tls_creds)
 
-        if self._auth_rq:
-            token = self._authenticate(endpoint)
-            if token:
-                token_plugin = _TokenAuthMetadataPlugin(token)
-                token_creds = grpc.metadata_call_credentials(token_plugin)
-                creds = grpc.composite_channel_credentials(self._tls_creds,
-                                                           token_creds)
+        creds = grpc.composite_channel_credentials(self._tls_creds,
+                                                   self._token_auth.call_creds)
+        grpc_channel = grpc.secure_channel(endpoint, creds)
+        try:
+            self._token_auth.ensure_token(grpc_channel, self._timeout)
 
-        return grpc.secure_channel(endpoint, creds)
+        except Exception:
+            grpc_channel.close()
+            raise
 
-    def _authenticate(self, endpoint):
-        grpc_channel = grpc.secure_channel(endpoint, self._tls_creds)
+        return grpc_channel
+
+    def _renew_token(self, stale_token):
         try:
-            auth_stub = AuthStub(grpc_channel)
-            rs = auth_stub.Authenticate(self._auth_rq, timeout=self._timeout)
-            return rs.token
-        except grpc.RpcError as e:
-            if "authentication is not enabled" in e.details():
-                _log.error("server authentication disabled; skipping")
-                return None
-            raise
-        finally:
-            grpc_channel.close()
+            self._token_auth.renew(stale_token)
 
+        except Exception:
+            _log.exception('Failed to renew auth token')
+
+    def _after_fork(self):
+        """
+        Called in a child process after fork, where only the thread that
+        forked exists. Locks that other threads of the parent might have held
+        are replaced, and so are channels, that must not be shared with the
+        parent.
+        """
+        self._endpoint_balancer._after_fork()
+        self._grpc_pool._after_fork()
+        self._endpoint_refresher._after_fork()
+        self._retry_policy._after_fork()
+        if self._token_auth:
+            self._token_auth._after_fork()
+        if self._read_flights:
+            self._read_flights = SingleFlight()
+        if self._watch_muxes:
+            self._watch_muxes = [WatchMux(self, mux.name)
+                                 for mux in self._watch_muxes]
 
-class _TokenAuthMetadataPlugin(grpc.AuthMetadataPlugin):
 
-    def __init__(self, token):
-        self._token = token
+def _after_fork_in_child():
+    for clt in list(_clients):
+        clt._after_fork()
 
-    def __call__(self, context, callback):
-        metadata = (('token', self._token),)
-        callback(metadata, None)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
 
 
 def _new_auth_rq(user, password):
@@ -266,9 +1091,28 @@ def _read_file(filename):
         return f.read()
 
 
-class _EndpointBalancer(object):
+class _EndpointStats(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.error_rate = 0.0
+        self.updated_at = time()
 
-    def __init__(self, endpoints):
+
+class _EndpointBalancer(object):
+    """
+    Keeps the list of cluster endpoints with the current one first. Unless
+    `by_latency` is set, endpoints are switched to in turn. Otherwise, the
+    next endpoint is the better scoring one of two picked at random, so that
+    slow or failing members get less traffic without the whole client herding
+    onto the single fastest one.
+
+    If `hedge_percentile` is given, then that percentile of read latencies is
+    tracked per endpoint to take hedge delays from, so that a slow member
+    does not delay hedging of reads sent to fast ones.
+    """
+
+    def __init__(self, endpoints, by_latency=False, hedge_percentile=None):
         self._mu = Lock()
 
         if isinstance(endpoints, str):
@@ -276,12 +1120,72 @@ class _EndpointBalancer(object):
 
         self._endpoints = [_normalize_endpoint(ep) for ep in endpoints]
         shuffle(self._endpoints)
+        self._by_latency = by_latency
+        self._stats = {}
+        self._hedge_percentile = hedge_percentile
+        self._hedge_delays = {}
 
     @property
     def current_endpoint(self):
         return self._endpoints[0]
 
+    def observe(self, endpoint, latency, err=None):
+        """
+        Records the outcome of a call made to the endpoint. Outcomes are only
+        needed to balance by latency, so they are not tracked otherwise.
+        """
+        if not self._by_latency:
+            return
+
+        failed = (isinstance(err, grpc.RpcError) and
+                  err.code() in _ENDPOINT_ERROR_CODES)
+        with self._mu:
+            stats = self._stats.get(endpoint)
+            if not stats:
+                stats = _EndpointStats(latency)
+                self._stats[endpoint] = stats
+
+            now = time()
+            error_rate = _decay(stats.error_rate, now - stats.updated_at)
+            stats.error_rate = _ewma(error_rate, 1.0 if failed else 0.0)
+            stats.latency = _ewma(stats.latency, latency)
+            stats.updated_at = now
+
+    def score(self, endpoint):
+        """
+        Returns the expected latency of a call to the endpoint inflated by its
+        recent error rate, the lower the better. Endpoints that have not been
+        called yet score as fast ones, so that they are given a try.
+        """
+        stats = self._stats.get(endpoint)
+        if not stats:
+            return _MIN_LATENCY
+
+        error_rate = _decay(stats.error_rate, time() - stats.updated_at)
+        return ((stats.latency + _MIN_LATENCY) *
+                (1 + _ERROR_PENALTY * error_rate))
+
+    def hedge_delay(self, endpoint):
+        """
+        Returns the `LatencyPercentile` of reads from the endpoint, that
+        hedged reads sent to it take their delay from.
+        """
+        hedge_delay = self._hedge_delays.get(endpoint)
+        if hedge_delay:
+            return hedge_delay
+
+        with self._mu:
+            hedge_delay = self._hedge_delays.get(endpoint)
+            if not hedge_delay:
+                hedge_delay = LatencyPercentile(self._hedge_percentile)
+                self._hedge_delays[endpoint] = hedge_delay
+
+            return hedge_delay
+
     def rotate_endpoint(self):
+        if self._by_latency:
+            return self._choose_endpoint()
+
         with self._mu:
             rotated_endpoint = self._endpoints[0]
             self._endpoints = self._endpoints[1:]
@@ -306,6 +1210,30 @@ class _EndpointBalancer(object):
             self._endpoints.insert(0, current_endpoint)
             _log.info('Endpoints refreshed: %s', self._endpoints)
 
+    def _after_fork(self):
+        self._mu = Lock()
+        for hedge_delay in self._hedge_delays.values():
+            hedge_delay._after_fork()
+
+    def _choose_endpoint(self):
+        with self._mu:
+            candidates = self._endpoints[1:] or self._endpoints
+            if len(candidates) > 2:
+                candidates = sample(candidates, 2)
+
+            endpoint = min(candidates, key=self.score)
+            self._endpoints.remove(endpoint)
+            self._endpoints.insert(0, endpoint)
+            return endpoint
+
+
+def _ewma(avg, value):
+    return avg + _EWMA_WEIGHT * (value - avg)
+
+
+def _decay(error_rate, elapsed):
+    return error_rate * 0.5 ** (elapsed / _ERROR_HALF_LIFE)
+
 
 def _normalize_endpoint(ep):
     parts = ep.lower().strip().split('//')
@@ -0,0 +1,238 @@
+import logging
+from collections import deque
+from enum import Enum
+from threading import Condition, Thread, current_thread
+from time import time
+
+from etcd3._watcher import call_event_handler
+
+_log = logging.getLogger(__name__)
+
+
+class Backpressure(Enum):
+    BLOCK = 0
+    DROP_OLDEST = 1
+    COALESCE = 2
+
+
+class EventDispatcher(object):
+    """
+    Runs watch event handlers on a pool of worker threads, so that watch
+    streams keep being drained while handlers are busy. Events are
+    partitioned into lanes by key, with a worker per lane, hence events of a
+    key are handled in the order they happened. Batches of events, see
+    `batch_events` of `Client.new_watcher`, are partitioned by the watched
+    key.
+
+    A lane holds up to `lane_size` pending items. When it is full, then
+    `backpressure` decides what happens: BLOCK makes the watch wait for a
+    free slot, DROP_OLDEST drops the oldest pending item, and COALESCE
+    replaces a pending event of the same key with the new one, or merges
+    pending and new batches of the same watch, and waits if there is none.
+
+    Events are queued on behalf of a watcher. When it is stopped, then its
+    events are no longer queued, not even by a dispatch that waits for a
+    free slot, and `drain` waits for the pending ones to be handled.
+    """
+
+    def __init__(self, name, workers, lane_size, backpressure):
+        self._name = name
+        self._lane_size = lane_size
+        self._backpressure = backpressure
+        self._lanes = [_Lane('%s_%d' % (name, i)) for i in range(workers)]
+        self._stop = False
+        for lane in self._lanes:
+            lane.thread = Thread(name=lane.name, target=self._run,
+                                 args=(lane,))
+            lane.thread.daemon = True
+
+    @property
+    def queue_depth(self):
+        """
+        The number of items waiting to be handled in all lanes.
+        """
+        return sum(len(lane.items) for lane in self._lanes)
+
+    @property
+    def dropped(self):
+        """
+        The number of items dropped by DROP_OLDEST backpressure so far.
+        """
+        return sum(lane.dropped for lane in self._lanes)
+
+    def start(self):
+        for lane in self._lanes:
+            lane.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the dispatcher after the pending items are handled.
+        """
+        self._stop = True
+        for lane in self._lanes:
+            with lane.cond:
+                lane.cond.notify_all()
+
+        deadline = None if timeout is None else time() + timeout
+        for lane in self._lanes:
+            if deadline is not None:
+                timeout = max(deadline - time(), 0)
+
+            lane.thread.join(timeout)
+
+        return not any(lane.thread.is_alive() for lane in self._lanes)
+
+    def drain(self, watcher, timeout=None):
+        """
+        Waits until pending events of the watcher are handled. Called when
+        the watcher is stopped, and then it also wakes up a dispatch of its
+        events that waits for a free slot, or before the watcher is resynced.
+        Returns False if the events are not handled after `timeout` seconds.
+        """
+        for lane in self._lanes:
+            with lane.cond:
+                lane.cond.notify_all()
+
+        deadline = None if timeout is None else time() + timeout
+        for lane in self._lanes:
+            # An event handler that stops its own watcher cannot wait for
+            # the lane it runs on.
+            if lane.thread is current_thread():
+                continue
+
+            if deadline is not None:
+                timeout = max(deadline - time(), 0)
+
+            with lane.cond:
+                if not lane.cond.wait_for(
+                        lambda: not _pending_unsafe(lane, watcher), timeout):
+                    return False
+
+        return True
+
+    def dispatch(self, event_handler, batch_events, key, events, revision,
+                 watcher=None):
+        """
+        Queues events of a watch response to be handled by the workers. The
+        parameters are those of `etcd3._watcher.call_event_handler`, and the
+        watcher the events come from. Events of a stopped watcher, see its
+        `stopped` property, are not queued.
+        """
+        if batch_events:
+            self._put(_Item(event_handler, True, key, list(events), revision,
+                            key, watcher))
+            return
+
+        for e in events:
+            self._put(_Item(event_handler, False, key, [e], revision,
+                            e.kv.key, watcher))
+
+    def _put(self, item):
+        lane = self._lanes[hash(item.lane_key) % len(self._lanes)]
+        with lane.cond:
+            while True:
+                if self._stop:
+                    raise RuntimeError('%s stopped' % (self._name,))
+
+                if item.watcher and item.watcher.stopped:
+                    return
+
+                if len(lane.items) < self._lane_size:
+                    break
+
+                if self._backpressure == Backpressure.DROP_OLDEST:
+                    dropped = lane.items.popleft()
+                    lane.dropped += 1
+                    _log.warn('%s dropped events: %s, revision=%d',
+                              lane.name, dropped.key, dropped.revision)
+                    break
+
+                if (self._backpressure == Backpressure.COALESCE and
+                        _coalesce_unsafe(lane.items, item)):
+                    return
+
+                lane.cond.wait()
+
+            lane.items.append(item)
+            lane.cond.notify_all()
+
+    def _run(self, lane):
+        _log.info('%s started', lane.name)
+        while True:
+            with lane.cond:
+                while not lane.items and not self._stop:
+                    lane.cond.wait()
+
+                if not lane.items:
+                    break
+
+                item = lane.items.popleft()
+                lane.current = item
+                lane.cond.notify_all()
+
+            call_event_handler(item.event_handler, item.batch_events,
+                               item.key, item.events, item.revision)
+            with lane.cond:
+                lane.current = None
+                lane.cond.notify_all()
+
+        _log.info('%s stopped', lane.name)
+
+
+class _Lane(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.cond = Condition()
+        self.items = deque()
+        self.dropped = 0
+        self.thread = None
+        # The item being handled.
+        self.current = None
+
+
+class _Item(object):
+
+    def __init__(self, event_handler, batch_events, key, events, revision,
+                 lane_key, watcher):
+        self.event_handler = event_handler
+        self.batch_events = batch_events
+        self.key = key
+        self.events = events
+        self.revision = revision
+        self.lane_key = lane_key
+        self.watcher = watcher
+
+
+def _pending_unsafe(lane, watcher):
+    """
+    Tells whether there are events of the watcher queued or being handled in
+    the lane.
+    """
+    if lane.current and lane.current.watcher is watcher:
+        return True
+
+    return any(item.watcher is watcher for item in lane.items)
+
+
+def _coalesce_unsafe(items, item):
+    """
+    Folds the item into the latest pending item of the same handler and key.
+    Returns False if there is no such item.
+    """
+    for i in range(len(items) - 1, -1, -1):
+        pending = items[i]
+        if (pending.event_handler != item.event_handler or
+                pending.watcher is not item.watcher or
+                pending.lane_key != item.lane_key):
+            continue
+
+        if item.batch_events:
+            pending.events.extend(item.events)
+            pending.revision = item.revision
+        else:
+            items[i] = item
+
+        return True
+
+    return False
@@ -0,0 +1,114 @@
+import logging
+import weakref
+from threading import Condition, Thread
+from time import time
+
+_MIN_REFRESH_INTERVAL = 1  # Seconds
+_FAILURE_PAUSE = 3  # Seconds
+
+_log = logging.getLogger(__name__)
+
+
+class EndpointRefresher(object):
+    """
+    Keeps the client endpoint list up to date with the cluster membership in
+    the background, so that connecting to an endpoint does not wait for
+    membership discovery. Membership is fetched every `interval` seconds,
+    and sooner when `hint` is called, e.g. on a connection failure, but no
+    more often than once a second. If discovery fails, the client keeps
+    dialing endpoints from the list it has.
+
+    The refresher holds the client by a weak reference and stops when the
+    client is closed or garbage collected.
+    """
+
+    def __init__(self, client, interval):
+        self._client_ref = weakref.ref(client)
+        self._interval = interval
+        self._cond = Condition()
+        self._hinted = False
+        self._started = False
+        self._stop = False
+        self._name = 'endpoint_refresher'
+        self._thread = Thread(name=self._name, target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """
+        Starts the refresher, unless it has already been started.
+        """
+        with self._cond:
+            if self._started:
+                return
+
+            self._started = True
+
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+        if not self._started:
+            return True
+
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def hint(self):
+        """
+        Tells the refresher that cluster topology may have changed.
+        """
+        with self._cond:
+            self._hinted = True
+            self._cond.notify()
+
+    def _after_fork(self):
+        """
+        Called in a child process after fork, where the refresher thread of
+        the parent does not exist. The refresher is started again on demand.
+        """
+        self._cond = Condition()
+        self._hinted = False
+        self._started = False
+        self._thread = Thread(name=self._name, target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        _log.info('%s started', self._name)
+        refresh_at = time()
+        while True:
+            with self._cond:
+                while not self._stop:
+                    # A hint may have come while discovery was in progress.
+                    if self._hinted:
+                        refresh_at = min(refresh_at, time() +
+                                         _MIN_REFRESH_INTERVAL)
+
+                    timeout = refresh_at - time()
+                    if timeout <= 0:
+                        break
+
+                    self._cond.wait(timeout)
+
+                if self._stop:
+                    break
+
+                self._hinted = False
+
+            client = self._client_ref()
+            if not client:
+                break
+
+            try:
+                client._discover_endpoints()
+                refresh_at = time() + self._interval
+
+            except Exception:
+                _log.exception('Failed to discover endpoints')
+                refresh_at = time() + min(self._interval, _FAILURE_PAUSE)
+
+            del client
+
+        _log.info('%s stopped', self._name)
@@ -0,0 +1,46 @@
+from collections import deque
+from threading import Lock
+
+_DEFAULT_WINDOW = 1000  # Samples
+_DEFAULT_DELAY = 0.05  # Seconds
+_MIN_DELAY = 0.001  # Seconds
+
+
+class LatencyPercentile(object):
+    """
+    Estimates a percentile of recent call latencies from a sliding window of
+    samples. The estimate is recomputed every tenth of the window to keep
+    `observe` cheap, and until then `initial` is reported.
+    """
+
+    def __init__(self, percentile, window=_DEFAULT_WINDOW,
+                 initial=_DEFAULT_DELAY):
+        if not 0 < percentile < 1:
+            raise ValueError('Percentile must be in (0, 1): %s' % percentile)
+
+        self._percentile = percentile
+        self._update_every = max(1, window // 10)
+        self._mu = Lock()
+        self._samples = deque(maxlen=window)
+        self._since_update = 0
+        self._value = initial
+
+    @property
+    def value(self):
+        return self._value
+
+    def _after_fork(self):
+        self._mu = Lock()
+
+    def observe(self, latency):
+        with self._mu:
+            self._samples.append(latency)
+            self._since_update += 1
+            if self._since_update < self._update_every:
+                return
+
+            self._since_update = 0
+            samples = sorted(self._samples)
+
+        i = min(len(samples) - 1, int(len(samples) * self._percentile))
+        self._value = max(_MIN_DELAY, samples[i])
@@ -36,6 +36,7 @@ class KeepAliver(object):
         _log.info('%s started', self._name)
         lease_id = None
         while not self._stop:
+            conn = None
             try:
                 lease_grant_rs = self._client.lease_grant(self._ttl)
                 lease_id = lease_grant_rs.ID
@@ -46,15 +47,19 @@ class KeepAliver(object):
                 _log.debug('Volatile key stored: %s, value=%s, ttl=%d, ',
                            self._key, self._value, lease_grant_rs.TTL)
 
-                lease_stub = self._client._get_lease_stub()
+                conn = self._client._acquire_stream_conn()
                 grpc_stream = GrpcBDStream(self._name + '_stream',
-                                           lease_stub.LeaseKeepAlive)
+                                           conn.lease_stub.LeaseKeepAlive)
             except Exception:
                 _log.exception('Failed to register: %s', self._key)
+                if conn:
+                    self._client._release_stream_conn(conn)
+
                 sleep(self._spin_pause)
                 continue
 
             effective_spin_pause = min(refresh_interval, self._spin_pause)
+            stream_err = None
             try:
                 refresh_at = time() + refresh_interval
                 while not self._stop:
@@ -69,11 +74,13 @@ class KeepAliver(object):
                         rs = grpc_stream.recv(self._client._timeout)
                         _log.debug('Lease refreshed: %s, rs=%s', lease_id, rs)
 
-                    except Exception:
+                    except Exception as err:
                         _log.exception('Failed to refresh lease: %s', lease_id)
+                        stream_err = err
                         break
             finally:
                 grpc_stream.close(self._client._timeout)
+                self._client._release_stream_conn(conn, stream_err)
     
         if lease_id:
             try:
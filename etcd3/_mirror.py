@@ -0,0 +1,116 @@
+import logging
+from bisect import bisect_left, insort
+from threading import Lock
+
+from etcd3 import _utils
+from etcd3._protobuf.kv_pb2 import Event
+from etcd3._watcher import range_snapshot
+
+_log = logging.getLogger(__name__)
+
+
+class PrefixMirror(object):
+    """
+    In-memory replica of all keys with the given prefix. It is loaded with a
+    ranged read and then kept up to date by a watch started from the
+    revision of the read. If the watch revision gets compacted, the mirror
+    is reloaded. Lookups and prefix scans are served from memory.
+    """
+
+    def __init__(self, client, prefix, spin_pause=None):
+        self._client = client
+        self._prefix = prefix
+        self._mu = Lock()
+        self._kvs = {}
+        self._sorted_keys = []
+        self._revision = 0
+        self._watcher = None
+        self._spin_pause = spin_pause
+
+    @property
+    def revision(self):
+        """
+        The revision of Etcd data that the mirror reflects.
+        """
+        return self._revision
+
+    def start(self):
+        """
+        Loads the prefix from Etcd and starts watching it for changes. It
+        raises an error if the prefix cannot be loaded.
+        """
+        kvs, revision = range_snapshot(self._client, self._prefix, True)
+        self._load(kvs, revision)
+        self._watcher = self._client.new_watcher(
+            self._prefix, self._handle_events, is_prefix=True,
+            start_revision=revision + 1, spin_pause=self._spin_pause,
+            batch_events=True, progress_notify=True,
+            resync_handler=self._load, progress_handler=self._handle_progress)
+        self._watcher.start()
+
+    def stop(self, timeout=None):
+        return self._watcher.stop(timeout)
+
+    def get(self, key):
+        """
+        Returns a KeyValue of the given key, or None if it does not exist.
+        """
+        return self._kvs.get(_utils.to_bytes(key))
+
+    def get_value(self, key):
+        kv = self.get(key)
+        if not kv:
+            return None
+
+        return kv.value
+
+    def get_prefix(self, prefix):
+        """
+        Returns a list of KeyValues of all keys with the given prefix sorted
+        by key.
+        """
+        prefix = _utils.to_bytes(prefix)
+        with self._mu:
+            kvs = []
+            i = bisect_left(self._sorted_keys, prefix)
+            while i < len(self._sorted_keys):
+                key = self._sorted_keys[i]
+                if not key.startswith(prefix):
+                    break
+
+                kvs.append(self._kvs[key])
+                i += 1
+
+            return kvs
+
+    def _load(self, kvs, revision):
+        kvs = {kv.key: kv for kv in kvs}
+        with self._mu:
+            self._kvs = kvs
+            self._sorted_keys = sorted(kvs)
+            self._revision = revision
+
+        _log.info('Mirror loaded: %s, keys=%d, revision=%d',
+                  self._prefix, len(kvs), revision)
+
+    def _handle_events(self, events, revision):
+        with self._mu:
+            for e in events:
+                key = e.kv.key
+                if e.type == Event.PUT:
+                    if key not in self._kvs:
+                        insort(self._sorted_keys, key)
+
+                    self._kvs[key] = e.kv
+
+                elif key in self._kvs:
+                    del self._kvs[key]
+                    del self._sorted_keys[bisect_left(self._sorted_keys, key)]
+
+            # The header revision can be past data that is yet to arrive,
+            # e.g. when Etcd catches up a lagging watch in parts.
+            self._revision = events[-1].kv.mod_revision
+
+    def _handle_progress(self, revision):
+        with self._mu:
+            self._revision = max(self._revision, revision)
@@ -0,0 +1,112 @@
+import logging
+from concurrent.futures import Future
+from threading import Condition, Thread
+from time import time
+
+from etcd3._protobuf.rpc_pb2 import RequestOp
+from etcd3._txn import chunk_ops, new_put_rq
+
+_log = logging.getLogger(__name__)
+
+
+class PutBatcher(object):
+    """
+    Coalesces puts issued within a time window, or until `max_txn_ops`
+    distinct keys are collected, into one transaction. If a key is put more
+    than once within a batch, then the last value wins. Every `put` returns a
+    future that is resolved with the revision of the transaction that stored
+    the batch.
+    """
+
+    def __init__(self, client, window, max_txn_ops, max_txn_bytes,
+                 max_in_flight):
+        self._client = client
+        self._window = window
+        self._max_txn_ops = max_txn_ops
+        self._max_txn_bytes = max_txn_bytes
+        self._max_in_flight = max_in_flight
+
+        self._cond = Condition()
+        self._batch = {}
+        self._futures = {}
+
+        self._name = 'put_batcher'
+        self._stop = False
+        self._thread = Thread(name=self._name, target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the batcher after the pending puts are committed.
+        """
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def put(self, key, val, lease_id=None):
+        rq = new_put_rq(key, val, lease_id)
+        rs_future = Future()
+        with self._cond:
+            if self._stop:
+                raise RuntimeError('%s stopped' % (self._name,))
+
+            self._batch[rq.key] = rq
+            self._futures.setdefault(rq.key, []).append(rs_future)
+            if len(self._batch) == 1 or len(self._batch) >= self._max_txn_ops:
+                self._cond.notify()
+
+        return rs_future
+
+    def _run(self):
+        _log.info('%s started', self._name)
+        while True:
+            with self._cond:
+                while not self._batch and not self._stop:
+                    self._cond.wait()
+
+                if not self._batch:
+                    break
+
+                flush_at = time() + self._window
+                while (len(self._batch) < self._max_txn_ops and
+                       not self._stop):
+                    timeout = flush_at - time()
+                    if timeout <= 0:
+                        break
+
+                    self._cond.wait(timeout)
+
+                batch, futures = self._batch, self._futures
+                self._batch, self._futures = {}, {}
+
+            self._commit(batch, futures)
+
+        _log.info('%s stopped', self._name)
+
+    def _commit(self, batch, futures):
+        keyed_ops = ((key, RequestOp(request_put=rq))
+                     for key, rq in batch.items())
+        chunks = chunk_ops(keyed_ops, self._max_txn_ops, self._max_txn_bytes)
+        try:
+            results = self._client._commit_chunks(chunks, self._max_in_flight)
+
+        except Exception as err:
+            _log.exception('Failed to commit batch of %d keys', len(batch))
+            for key_futures in futures.values():
+                for rs_future in key_futures:
+                    rs_future.set_exception(err)
+            return
+
+        for result in results:
+            for key in result.keys:
+                for rs_future in futures[key]:
+                    if result.error:
+                        rs_future.set_exception(result.error)
+                    else:
+                        rs_future.set_result(result.response.header.revision)
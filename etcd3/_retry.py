@@ -0,0 +1,93 @@
+from random import uniform
+from threading import Lock
+from time import time
+
+import grpc
+
+_DEFAULT_MAX_ATTEMPTS = 3
+_DEFAULT_BASE_DELAY = 0.05  # Seconds
+_DEFAULT_MAX_DELAY = 2  # Seconds
+_DEFAULT_BUDGET_RATE = 10  # Retries per second
+_DEFAULT_BUDGET_BURST = 20  # Retries
+_DEFAULT_RETRY_CODES = frozenset([grpc.StatusCode.UNAVAILABLE,
+                                  grpc.StatusCode.RESOURCE_EXHAUSTED])
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a failed Etcd call is retried. A call is retried
+    on gRPC errors with one of `retry_codes` status codes, on expired auth
+    tokens, and when the channel it was in flight on was closed, up to
+    `max_attempts` attempts in total. Before attempt n+1 the client sleeps a
+    random delay between 0 and `base_delay * 2^(n-1)` capped at `max_delay`
+    (exponential backoff with full jitter), so that clients failing at the
+    same time do not reconnect at the same time.
+
+    Retries are also drawn from a token bucket that holds up to
+    `budget_burst` tokens and is refilled at `budget_rate` tokens per second.
+    When the bucket is empty calls fail without retries, so that during an
+    outage clients do not multiply the load on the cluster. A policy instance
+    can be shared by several clients to give them a common budget.
+
+    Custom policies should override `next_delay`.
+    """
+
+    def __init__(self, max_attempts=_DEFAULT_MAX_ATTEMPTS,
+                 base_delay=_DEFAULT_BASE_DELAY, max_delay=_DEFAULT_MAX_DELAY,
+                 retry_codes=_DEFAULT_RETRY_CODES,
+                 budget_rate=_DEFAULT_BUDGET_RATE,
+                 budget_burst=_DEFAULT_BUDGET_BURST):
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._retry_codes = frozenset(retry_codes)
+        self._budget_rate = budget_rate
+        self._budget_burst = budget_burst
+
+        self._mu = Lock()
+        self._tokens = budget_burst
+        self._refilled_at = time()
+
+    def next_delay(self, attempt, err, time_left):
+        """
+        Returns the number of seconds to wait before retrying a call whose
+        attempt number `attempt`, counting from 1, failed with `err`, or None
+        if the call should not be retried. `time_left` is the number of
+        seconds left until the call deadline.
+        """
+        if attempt >= self._max_attempts or not self.is_retryable(err):
+            return None
+
+        delay = uniform(0, min(self._max_delay,
+                               self._base_delay * 2 ** (attempt - 1)))
+        if delay >= time_left or not self._take_token():
+            return None
+
+        return delay
+
+    def is_retryable(self, err):
+        code = err.code()
+        if code == grpc.StatusCode.UNAUTHENTICATED:
+            return err.details().endswith('invalid auth token')
+
+        # Calls in flight are cancelled when a broken channel is closed.
+        if code == grpc.StatusCode.CANCELLED:
+            return err.details() == 'Channel closed!'
+
+        return code in self._retry_codes
+
+    def _after_fork(self):
+        self._mu = Lock()
+
+    def _take_token(self):
+        with self._mu:
+            now = time()
+            self._tokens = min(self._budget_burst,
+                               self._tokens +
+                               (now - self._refilled_at) * self._budget_rate)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
@@ -0,0 +1,53 @@
+from threading import Event, Lock
+
+
+class SingleFlight(object):
+    """
+    Suppresses duplicate calls: while a call with a given key is in flight,
+    concurrent calls with the same key wait for it and receive its result,
+    or its error, instead of making calls of their own.
+    """
+
+    def __init__(self):
+        self._mu = Lock()
+        self._flights = {}
+
+    def do(self, key, f):
+        with self._mu:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not is_leader:
+            return flight.wait()
+
+        try:
+            flight.result = f()
+
+        except Exception as err:
+            flight.error = err
+
+        finally:
+            with self._mu:
+                del self._flights[key]
+
+            flight.done.set()
+
+        return flight.wait()
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+
+        return self.result
@@ -0,0 +1,206 @@
+import logging
+import weakref
+from threading import Condition, RLock, Thread
+
+import grpc
+
+from etcd3._protobuf.rpc_pb2_grpc import AuthStub
+
+_FAILURE_PAUSE = 3  # Seconds
+
+_log = logging.getLogger(__name__)
+
+
+class TokenAuth(object):
+    """
+    Auth token shared by all channels of a client. The token is obtained
+    when the first channel is dialed, over that very channel, and is then
+    renewed in the background every 2/3 of `token_ttl`, so it does not
+    expire while the client is in use. If Etcd rejects the token anyway,
+    `renew` swaps it for a new one without rebuilding channels.
+
+    The background renewal holds the client by a weak reference and stops
+    when the client is closed or garbage collected. `AsyncClient`
+    authenticates and renews the token with coroutines of its own, and only
+    shares the token with its channels through `call_creds`.
+    """
+
+    def __init__(self, client, auth_rq, token_ttl):
+        self._client_ref = weakref.ref(client)
+        self._auth_rq = auth_rq
+        self._refresh_interval = token_ttl * 2 / 3.
+        self._mu = RLock()
+        self._authenticated = False
+        self._token = None
+        self._plugin = _TokenAuthMetadataPlugin(None)
+        self.call_creds = grpc.metadata_call_credentials(self._plugin)
+
+        self._cond = Condition()
+        self._started = False
+        self._stop = False
+        self._name = 'token_refresher'
+        self._thread = Thread(name=self._name, target=self._run)
+        self._thread.daemon = True
+
+    @property
+    def token(self):
+        return self._token
+
+    @property
+    def authenticated(self):
+        return self._authenticated
+
+    @property
+    def refresh_interval(self):
+        return self._refresh_interval
+
+    def ensure_token(self, grpc_channel, timeout):
+        """
+        Authenticates over the given channel, unless a token has already
+        been obtained.
+        """
+        if not self._authenticated:
+            with self._mu:
+                if not self._authenticated:
+                    rs = authenticate(AuthStub(grpc_channel), self._auth_rq,
+                                      timeout)
+                    self._set_token_unsafe(rs)
+
+        if self._token:
+            self._start()
+
+    def renew(self, stale_token):
+        """
+        Replaces the token that Etcd rejected, unless that has already been
+        done by another thread.
+        """
+        with self._mu:
+            if self._token != stale_token:
+                return
+
+            _log.info('Renewing rejected auth token')
+            self._renew_unsafe()
+
+    def set_token(self, rs):
+        """
+        Replaces the token with the one of the given authenticate response,
+        or with none if authentication is not enabled.
+        """
+        with self._mu:
+            self._set_token_unsafe(rs)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+        if not self._thread.is_alive():
+            return True
+
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _after_fork(self):
+        """
+        Called in a child process after fork. The token obtained by the parent
+        is kept, and the renewal thread is started again on demand.
+        """
+        self._mu = RLock()
+        self._cond = Condition()
+        self._started = False
+        self._thread = Thread(name=self._name, target=self._run)
+        self._thread.daemon = True
+
+    def _start(self):
+        with self._cond:
+            if self._started:
+                return
+
+            self._started = True
+
+        self._thread.start()
+
+    def _renew_unsafe(self):
+        client = self._client_ref()
+        if not client:
+            return
+
+        rs = client._authenticate(self._auth_rq)
+        self._set_token_unsafe(rs)
+
+    def _set_token_unsafe(self, rs):
+        self._authenticated = True
+        self._token = rs.token if rs else None
+        self._plugin.set_token(self._token)
+
+    def _run(self):
+        _log.info('%s started', self._name)
+        pause = self._refresh_interval
+        while True:
+            with self._cond:
+                if not self._stop:
+                    self._cond.wait(pause)
+
+                if self._stop:
+                    break
+
+            if not self._client_ref():
+                break
+
+            try:
+                with self._mu:
+                    self._renew_unsafe()
+
+                if not self._token:
+                    break
+
+                pause = self._refresh_interval
+
+            except Exception:
+                _log.exception('Failed to renew auth token')
+                pause = min(self._refresh_interval, _FAILURE_PAUSE)
+
+        _log.info('%s stopped', self._name)
+
+
+class _TokenAuthMetadataPlugin(grpc.AuthMetadataPlugin):
+    """
+    Adds the current auth token to every call but `Authenticate`, the token
+    can be swapped at any time.
+    """
+
+    def __init__(self, token):
+        self._token = token
+
+    def set_token(self, token):
+        self._token = token
+
+    def __call__(self, context, callback):
+        token = self._token
+        if not token or context.method_name.endswith('/Authenticate'):
+            callback((), None)
+            return
+
+        metadata = (('token', token),)
+        callback(metadata, None)
+
+
+def is_token_expired(err):
+    return (isinstance(err, grpc.RpcError) and
+            err.code() == grpc.StatusCode.UNAUTHENTICATED and
+            err.details().endswith('invalid auth token'))
+
+
+def authenticate(auth_stub, auth_rq, timeout):
+    """
+    Returns an authenticate response, or None if authentication is not
+    enabled in the cluster.
+    """
+    try:
+        return auth_stub.Authenticate(auth_rq, timeout=timeout)
+
+    except grpc.RpcError as e:
+        if "authentication is not enabled" in e.details():
+            _log.error("server authentication disabled; skipping")
+            return None
+        raise
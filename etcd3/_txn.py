@@ -0,0 +1,171 @@
+from collections import namedtuple
+from enum import Enum
+
+from etcd3 import _utils
+from etcd3._protobuf.rpc_pb2 import (Compare, DeleteRangeRequest, PutRequest,
+                                     RangeRequest, RequestOp, TxnRequest)
+
+# Result of a transaction sent on behalf of a bulk operation. Either
+# `response` or `error` is set.
+TxnChunkResult = namedtuple('TxnChunkResult', ['keys', 'response', 'error'])
+
+
+class CompareResult(Enum):
+    EQUAL = 0
+    GREATER = 1
+    LESS = 2
+    NOT_EQUAL = 3
+
+
+class Txn(object):
+    """
+    Builder of an Etcd transaction. If all `if_*` conditions hold, then
+    `then_*` operations are executed, otherwise `else_*` operations are. The
+    transaction is sent to Etcd in one round trip by `commit`, e.g.:
+
+        rs = (clt.txn()
+              .if_version('/foo', CompareResult.EQUAL, 0)
+              .then_put('/foo', 'bar')
+              .else_get('/foo')
+              .commit())
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._rq = TxnRequest()
+
+    def if_value(self, key, result, value):
+        return self._compare(key, result, Compare.VALUE,
+                             value=_utils.to_bytes(value))
+
+    def if_version(self, key, result, version):
+        return self._compare(key, result, Compare.VERSION, version=version)
+
+    def if_create_revision(self, key, result, revision):
+        return self._compare(key, result, Compare.CREATE,
+                             create_revision=revision)
+
+    def if_mod_revision(self, key, result, revision):
+        return self._compare(key, result, Compare.MOD, mod_revision=revision)
+
+    def if_lease(self, key, result, lease_id):
+        return self._compare(key, result, Compare.LEASE, lease=lease_id)
+
+    def then_get(self, key, is_prefix=False):
+        self._rq.success.add(request_range=new_range_rq(key, is_prefix))
+        return self
+
+    def then_put(self, key, val, lease_id=None):
+        self._rq.success.add(request_put=new_put_rq(key, val, lease_id))
+        return self
+
+    def then_delete(self, key, is_prefix=False):
+        self._rq.success.add(request_delete_range=new_delete_rq(key,
+                                                                is_prefix))
+        return self
+
+    def else_get(self, key, is_prefix=False):
+        self._rq.failure.add(request_range=new_range_rq(key, is_prefix))
+        return self
+
+    def else_put(self, key, val, lease_id=None):
+        self._rq.failure.add(request_put=new_put_rq(key, val, lease_id))
+        return self
+
+    def else_delete(self, key, is_prefix=False):
+        self._rq.failure.add(request_delete_range=new_delete_rq(key,
+                                                                is_prefix))
+        return self
+
+    def commit(self):
+        return self._client._txn(self._rq)
+
+    def commit_async(self):
+        """
+        Non-blocking variant of `commit`, returns a future of its result.
+        """
+        return self._client._txn_async(self._rq)
+
+    def _compare(self, key, result, target, **kwargs):
+        self._rq.compare.add(key=_utils.to_bytes(key),
+                             result=result.value,
+                             target=target,
+                             **kwargs)
+        return self
+
+
+def new_range_rq(key, is_prefix=False, limit=0, sort_order=0, sort_target=0,
+                 **kwargs):
+    rq = RangeRequest(key=_utils.to_bytes(key),
+                      limit=limit,
+                      sort_order=sort_order,
+                      sort_target=sort_target,
+                      **kwargs)
+    if is_prefix:
+        rq.range_end = _utils.range_end(rq.key)
+
+    return rq
+
+
+def new_put_rq(key, val, lease_id=None):
+    return PutRequest(key=_utils.to_bytes(key),
+                      value=_utils.to_bytes(val),
+                      lease=lease_id)
+
+
+def new_delete_rq(key, is_prefix=False):
+    rq = DeleteRangeRequest(key=_utils.to_bytes(key))
+    if is_prefix:
+        rq.range_end = _utils.range_end(rq.key)
+
+    return rq
+
+
+def new_range_op(key, is_prefix=False):
+    return RequestOp(request_range=new_range_rq(key, is_prefix))
+
+
+def new_put_op(key, val, lease_id=None):
+    return RequestOp(request_put=new_put_rq(key, val, lease_id))
+
+
+def new_delete_op(key, is_prefix=False):
+    return RequestOp(request_delete_range=new_delete_rq(key, is_prefix))
+
+
+def dedup_ops(keyed_ops):
+    """
+    Leaves only the last operation of every key in (key, RequestOp) pairs,
+    for Etcd rejects a transaction with more than one operation on a key.
+    """
+    ops = {}
+    for key, op in keyed_ops:
+        ops[_utils.to_bytes(key)] = key, op
+
+    return ops.values()
+
+
+def chunk_ops(keyed_ops, max_ops, max_bytes):
+    """
+    Packs (key, RequestOp) pairs into transactions of at most `max_ops`
+    operations and `max_bytes` serialized operation size. An operation that
+    does not fit into `max_bytes` by itself is sent in a transaction alone.
+    Yields (keys, TxnRequest) tuples.
+    """
+    keys = []
+    rq = TxnRequest()
+    size = 0
+    for key, op in keyed_ops:
+        op_size = op.ByteSize()
+        if keys and (len(keys) >= max_ops or size + op_size > max_bytes):
+            yield keys, rq
+            keys = []
+            rq = TxnRequest()
+            size = 0
+
+        keys.append(key)
+        rq.success.add().CopyFrom(op)
+        size += op_size
+
+    if keys:
+        yield keys, rq
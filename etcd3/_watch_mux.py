@@ -0,0 +1,438 @@
+import logging
+from collections import deque
+from itertools import count
+from threading import Condition, Thread, current_thread
+from time import sleep, time
+
+import grpc
+
+from etcd3._grpc_bd_stream import GrpcBDStream
+from etcd3._protobuf.rpc_pb2 import (WatchCancelRequest, WatchCreateRequest,
+                                     WatchRequest)
+from etcd3._watcher import (call_event_handler, call_progress_handler,
+                            new_watch_create_rq, resume_compacted, resync)
+
+_DEFAULT_SPIN_PAUSE = 3  # seconds
+# Create and cancel requests of many watches can be sent at once, e.g. when
+# the stream is reopened.
+_STREAM_BUF_SIZE = 64
+
+_log = logging.getLogger(__name__)
+
+
+class WatchMux(object):
+    """
+    Runs many watches over one gRPC Watch stream. Watches are created on the
+    stream with client assigned watch IDs and canceled by them, and responses
+    are routed to watches by their IDs. When the stream fails, it is opened
+    again and every watch is created anew from the revision that follows the
+    last one it has seen. Client assigned watch IDs require Etcd 3.4+, older
+    versions assign IDs of their own, and then the stream fails.
+
+    The stream, and the thread that serves it, only exist while there are
+    watches. Event handlers are called on that thread, hence a slow handler
+    delays events of all watches of the multiplexer, unless the watches have
+    an event dispatcher.
+    """
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+        self._cond = Condition()
+        self._watches = {}
+        self._next_watch_id = count(1)
+        self._grpc_stream = None
+        # IDs of watches to be created, in the order the create requests
+        # were sent. Etcd acknowledges them in that order.
+        self._creating = deque()
+        # Set when a request could not be sent, the stream is reopened then
+        # for the watches to be created anew.
+        self._send_failed = False
+        self._thread = None
+        self._retries = []
+        self._dispatching_to = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def size(self):
+        return len(self._watches)
+
+    def add(self, watcher):
+        with self._cond:
+            watcher.watch_id = next(self._next_watch_id)
+            self._watches[watcher.watch_id] = watcher
+            if self._grpc_stream:
+                self._send_create_unsafe(watcher)
+
+            if not self._thread:
+                self._thread = Thread(name=self._name, target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, watcher, timeout=None):
+        """
+        Cancels the watch. Returns False if its event handler is still
+        running after `timeout` seconds.
+        """
+        with self._cond:
+            if self._watches.pop(watcher.watch_id, None) is None:
+                return True
+
+            # A watch that is not created yet is canceled when it is.
+            if self._grpc_stream and watcher.created:
+                self._send_unsafe(WatchRequest(cancel_request=(
+                    WatchCancelRequest(watch_id=watcher.watch_id))))
+
+            if current_thread() is self._thread:
+                return True
+
+            return self._cond.wait_for(
+                lambda: self._dispatching_to is not watcher, timeout)
+
+    def _run(self):
+        _log.info('%s started', self._name)
+        while True:
+            with self._cond:
+                if not self._watches:
+                    self._thread = None
+                    break
+
+                spin_pause = self._spin_pause_unsafe()
+
+            conn = None
+            try:
+                conn = self._client._acquire_stream_conn()
+                grpc_stream = GrpcBDStream(self._name + '_stream',
+                                           conn.watch_stub.Watch,
+                                           _STREAM_BUF_SIZE)
+            except Exception:
+                _log.exception('Failed to open watch stream: %s', self._name)
+                if conn:
+                    self._client._release_stream_conn(conn)
+
+                sleep(spin_pause)
+                continue
+
+            stream_err = None
+            try:
+                with self._cond:
+                    self._grpc_stream = grpc_stream
+                    self._creating.clear()
+                    self._send_failed = False
+                    self._retries = []
+                    for watcher in self._watches.values():
+                        watcher.created = False
+                        self._send_create_unsafe(watcher)
+
+                while True:
+                    with self._cond:
+                        if not self._watches:
+                            break
+
+                        timeout = self._retry_due_unsafe(spin_pause)
+                        if self._send_failed:
+                            raise RuntimeError('Failed to send watch request')
+
+                    rs = grpc_stream.recv(timeout)
+                    if rs:
+                        self._handle_response(rs)
+
+            except grpc.RpcError as err:
+                severity = logging.ERROR
+                # See `etcd3._watcher.Watcher`.
+                if err.code() == grpc.StatusCode.CANCELLED:
+                    severity = logging.WARN
+
+                stream_err = err
+                _log.log(severity, 'Watch stream failed: %s', self._name)
+                sleep(spin_pause)
+
+            except Exception:
+                _log.exception('Watch stream failed: %s', self._name)
+                sleep(spin_pause)
+
+            finally:
+                with self._cond:
+                    self._grpc_stream = None
+
+                grpc_stream.close(self._client._timeout)
+                self._client._release_stream_conn(conn, stream_err)
+
+        _log.info('%s stopped', self._name)
+
+    def _handle_response(self, rs):
+        with self._cond:
+            watch_id = rs.watch_id
+            if rs.created:
+                watch_id = self._check_created_unsafe(rs)
+
+            watcher = self._watches.get(watch_id)
+            if not watcher:
+                # The watch has been removed before it was created.
+                if rs.created and not rs.canceled:
+                    self._send_unsafe(WatchRequest(cancel_request=(
+                        WatchCancelRequest(watch_id=watch_id))))
+                return
+
+            if rs.created:
+                _log.info('Watch created: %s', watcher.key)
+                watcher.created = True
+                if not watcher.revision:
+                    watcher.revision = rs.header.revision + 1
+
+            if rs.canceled:
+                watcher.created = False
+                self._renew_watch_id_unsafe(watcher, rs.compact_revision)
+                if not rs.compact_revision:
+                    _log.error('Watch canceled: %s, reason=%s', watcher.key,
+                               rs.cancel_reason)
+
+            # See `etcd3._watcher.Watcher`.
+            if rs.fragment:
+                watcher.fragments.extend(rs.events)
+                return
+
+            events = rs.events
+            if watcher.fragments:
+                events = watcher.fragments + list(rs.events)
+                watcher.fragments = []
+
+            if not events and not rs.canceled:
+                if rs.created:
+                    return
+
+                watcher.revision = max(watcher.revision,
+                                       rs.header.revision + 1)
+                if not watcher.notifies_progress:
+                    return
+
+            self._dispatching_to = watcher
+
+        retry_at = None
+        try:
+            if rs.compact_revision:
+                try:
+                    watcher.revision = watcher.handle_compacted(
+                        rs.compact_revision)
+
+                except Exception:
+                    _log.exception('Compacted handler failed: %s',
+                                   watcher.key)
+                    retry_at = time() + watcher.spin_pause
+
+            elif rs.canceled:
+                retry_at = time() + watcher.spin_pause
+                try:
+                    watcher.revision = watcher.handle_canceled()
+
+                except Exception:
+                    _log.exception('Resync failed: %s', watcher.key)
+
+            if events:
+                watcher.handle_events(events, rs.header.revision)
+
+            elif not rs.canceled:
+                watcher.handle_progress(rs.header.revision)
+
+        finally:
+            with self._cond:
+                self._dispatching_to = None
+                self._cond.notify_all()
+                if (rs.canceled and
+                        self._watches.get(watcher.watch_id) is watcher):
+                    if retry_at:
+                        self._retries.append((retry_at, watcher))
+                    else:
+                        self._send_create_unsafe(watcher)
+
+    def _retry_due_unsafe(self, spin_pause):
+        """
+        Creates again watches canceled by Etcd that are due for a retry.
+        Returns the time until the next retry, but no more than
+        `spin_pause`.
+        """
+        now = time()
+        timeout = spin_pause
+        retries = []
+        for retry_at, watcher in self._retries:
+            if self._watches.get(watcher.watch_id) is not watcher:
+                continue
+
+            if retry_at <= now:
+                self._send_create_unsafe(watcher)
+                continue
+
+            retries.append((retry_at, watcher))
+            timeout = min(timeout, retry_at - now)
+
+        self._retries = retries
+        return timeout
+
+    def _check_created_unsafe(self, rs):
+        """
+        Matches a created response with the create request it acknowledges,
+        and returns the ID of the watch. A create request that Etcd rejects
+        is acknowledged with ID -1, but any other ID that differs from the
+        requested one means that Etcd ignores client assigned IDs.
+        """
+        watch_id = self._creating.popleft() if self._creating else None
+        if rs.watch_id == watch_id or (rs.canceled and rs.watch_id == -1):
+            return watch_id
+
+        raise RuntimeError('Etcd assigned watch ID %d instead of %s, client '
+                           'assigned watch IDs require Etcd 3.4+' %
+                           (rs.watch_id, watch_id))
+
+    def _renew_watch_id_unsafe(self, watcher, cancel):
+        """
+        Gives a watch canceled by Etcd a new ID to be created again with.
+        Etcd keeps the ID of a watch canceled due to compaction in use until
+        the client cancels it, therefore `cancel` tells to do so.
+        """
+        if cancel:
+            self._send_unsafe(WatchRequest(cancel_request=(
+                WatchCancelRequest(watch_id=watcher.watch_id))))
+
+        del self._watches[watcher.watch_id]
+        watcher.watch_id = next(self._next_watch_id)
+        self._watches[watcher.watch_id] = watcher
+
+    def _spin_pause_unsafe(self):
+        return min(watcher.spin_pause for watcher in self._watches.values())
+
+    def _send_create_unsafe(self, watcher):
+        watcher.fragments = []
+        watch_create_rq = WatchCreateRequest()
+        watch_create_rq.CopyFrom(watcher.watch_create_rq)
+        watch_create_rq.watch_id = watcher.watch_id
+        watch_create_rq.start_revision = watcher.revision
+        if self._send_unsafe(WatchRequest(create_request=watch_create_rq)):
+            self._creating.append(watcher.watch_id)
+
+    def _send_unsafe(self, watch_rq):
+        try:
+            self._grpc_stream.send(watch_rq, self._client._timeout)
+            return True
+
+        except Exception:
+            _log.exception('Failed to send watch request: %s, rq=%s',
+                           self._name, watch_rq)
+            self._send_failed = True
+            return False
+
+
+class MuxWatcher(object):
+    """
+    Counterpart of `etcd3._watcher.Watcher` that watches over the shared
+    stream of a `WatchMux` rather than over a stream and threads of its own.
+    """
+
+    def __init__(self, mux, key, event_handler, is_prefix=False,
+                 start_revision=0, spin_pause=None, compacted_handler=None,
+                 batch_events=False, filters=None, prev_kv=False,
+                 progress_notify=False, fragment=False, resync_handler=None,
+                 dispatcher=None, progress_handler=None):
+        self._mux = mux
+        self._key = key
+        self._is_prefix = is_prefix
+        self._event_handler = event_handler
+        self._compacted_handler = compacted_handler
+        self._resync_handler = resync_handler
+        self._progress_handler = progress_handler
+        self._batch_events = batch_events
+        self._dispatcher = dispatcher
+        self.spin_pause = spin_pause or _DEFAULT_SPIN_PAUSE
+        self.watch_create_rq = new_watch_create_rq(
+            key, is_prefix, 0, filters, prev_kv, progress_notify, fragment)
+
+        self._stopped = False
+
+        # Maintained by the multiplexer.
+        self.watch_id = None
+        self.created = False
+        self.revision = start_revision
+        self.fragments = []
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    @property
+    def notifies_progress(self):
+        return self._progress_handler is not None
+
+    def start(self):
+        self._stopped = False
+        self._mux.add(self)
+
+    def stop(self, timeout=None):
+        """
+        Cancels the watch. If there is a dispatcher, then it also waits for
+        events queued there to be handled. Returns False if that takes
+        longer than `timeout` seconds.
+        """
+        self._stopped = True
+        deadline = None if timeout is None else time() + timeout
+        drained = True
+        if self._dispatcher:
+            drained = self._dispatcher.drain(self, timeout)
+            if deadline is not None:
+                timeout = max(deadline - time(), 0)
+
+        return self._mux.remove(self, timeout) and drained
+
+    def handle_events(self, events, revision):
+        """
+        Calls the event handler with events of a watch response, and advances
+        the revision to resume watching from past them.
+        """
+        if self._dispatcher:
+            self._dispatcher.dispatch(self._event_handler,
+                                      self._batch_events, self._key, events,
+                                      revision, self)
+        else:
+            call_event_handler(self._event_handler, self._batch_events,
+                               self._key, events, revision)
+        self.revision = events[-1].kv.mod_revision + 1
+
+    def handle_progress(self, revision):
+        """
+        Calls the progress handler on a progress notification.
+        """
+        call_progress_handler(self._progress_handler, self._key, revision)
+
+    def handle_compacted(self, compact_revision):
+        """
+        See `etcd3._watcher.resume_compacted`.
+        """
+        self._drain_dispatcher()
+        return resume_compacted(self._mux._client, self._key,
+                                self._is_prefix, compact_revision,
+                                self._compacted_handler, self._resync_handler)
+
+    def handle_canceled(self):
+        """
+        Called when Etcd cancels the watch for a reason other than
+        compaction. Returns the revision to resume watching from, past a
+        resync if there is a resync handler, see `etcd3._watcher.resync`.
+        """
+        if not self._resync_handler:
+            return self.revision
+
+        self._drain_dispatcher()
+        return resync(self._mux._client, self._key, self._is_prefix,
+                      self._resync_handler)
+
+    def _drain_dispatcher(self):
+        """
+        See `etcd3._watcher.Watcher._drain_dispatcher`.
+        """
+        if self._dispatcher:
+            self._dispatcher.drain(self)
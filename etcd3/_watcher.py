@@ -1,6 +1,7 @@
 import logging
+from enum import Enum
 from threading import Thread
-from time import sleep
+from time import sleep, time
 
 import grpc
 
@@ -13,24 +14,41 @@ _DEFAULT_SPIN_PAUSE = 3  # seconds
 _log = logging.getLogger(__name__)
 
 
+class WatchFilter(Enum):
+    NOPUT = 0
+    NODELETE = 1
+
+
 class Watcher(object):
+    """
+    Watches a key, or a key prefix, and calls `event_handler` with every
+    event. If `batch_events` is True, then the handler is rather called with
+    all events of a watch response at once, along with the response header
+    revision, that can be past the last event. If there is a `dispatcher`,
+    then the handler is called on its workers rather than on the watcher
+    thread. See `Client.new_watcher` for the other parameters.
+    """
 
     def __init__(self, client, key, event_handler, is_prefix=False,
-                 start_revision=0, spin_pause=None):
+                 start_revision=0, spin_pause=None, compacted_handler=None,
+                 batch_events=False, filters=None, prev_kv=False,
+                 progress_notify=False, fragment=False, resync_handler=None,
+                 dispatcher=None, progress_handler=None):
         self._client = client
         self._key = key
         self._is_prefix = is_prefix
         self._start_revision = start_revision
         self._event_handler = event_handler
+        self._compacted_handler = compacted_handler
+        self._resync_handler = resync_handler
+        self._progress_handler = progress_handler
+        self._batch_events = batch_events
+        self._dispatcher = dispatcher
         self._spin_pause = spin_pause or _DEFAULT_SPIN_PAUSE
 
-        watch_create_rq = WatchCreateRequest(
-            key=_utils.to_bytes(key),
-            start_revision=start_revision)
-
-        if is_prefix:
-            watch_create_rq.range_end = _utils.range_end(watch_create_rq.key)
-
+        watch_create_rq = new_watch_create_rq(
+            key, is_prefix, start_revision, filters, prev_kv,
+            progress_notify, fragment)
         self._watch_rq = WatchRequest(create_request=watch_create_rq)
 
         self._name = 'watcher_' + key
@@ -38,26 +56,45 @@ class Watcher(object):
         self._thread = Thread(name=self._name, target=self._run)
         self._thread.daemon = True
 
+    @property
+    def stopped(self):
+        return self._stop
+
     def start(self):
         self._thread.start()
 
     def stop(self, timeout=None):
+        """
+        Stops the watcher. If there is a dispatcher, then it also waits for
+        events queued there to be handled. Returns False if that takes
+        longer than `timeout` seconds.
+        """
         self._stop = True
+        deadline = None if timeout is None else time() + timeout
+        drained = True
+        if self._dispatcher:
+            drained = self._dispatcher.drain(self, timeout)
+            if deadline is not None:
+                timeout = max(deadline - time(), 0)
+
         self._thread.join(timeout)
-        return not self._thread.is_alive()
+        return drained and not self._thread.is_alive()
 
     def _run(self):
         _log.info('%s started', self._name)
         start_revision = None
         while not self._stop:
+            conn = None
             try:
                 # Test if the key can be accessed. That is needed to trigger
                 # reconnects and also checks if there is enough permissions.
-                self._client.get(self._key, self._is_prefix)
+                # Only the count is requested, for a prefix can be huge.
+                self._client.get(self._key, self._is_prefix, limit=1,
+                                 count_only=True)
 
-                watch_stub = self._client._get_watch_stub()
+                conn = self._client._acquire_stream_conn()
                 grpc_stream = GrpcBDStream(self._name + '_stream',
-                                           watch_stub.Watch)
+                                           conn.watch_stub.Watch)
                 if start_revision:
                     self._watch_rq.create_request.start_revision = start_revision
 
@@ -65,9 +102,14 @@ class Watcher(object):
 
             except Exception:
                 _log.exception('Failed to initialize watch: %s', self._key)
+                if conn:
+                    self._client._release_stream_conn(conn)
+
                 sleep(self._spin_pause)
                 continue
 
+            stream_err = None
+            fragments = []
             try:
                 while not self._stop:
                     rs = grpc_stream.recv(self._spin_pause)
@@ -76,14 +118,66 @@ class Watcher(object):
 
                     if rs.created:
                         _log.info('Watch created: %s', self._key)
+                        # Resume from the revision the watch was created at,
+                        # rather than from whatever revision is current then.
+                        if not start_revision and not self._start_revision:
+                            start_revision = rs.header.revision + 1
+
+                    if rs.compact_revision:
+                        self._drain_dispatcher()
+                        start_revision = resume_compacted(
+                            self._client, self._key, self._is_prefix,
+                            rs.compact_revision, self._compacted_handler,
+                            self._resync_handler)
+                        break
 
-                    for e in rs.events:
-                        start_revision = e.kv.mod_revision + 1
-                        try:
-                            self._event_handler(e)
+                    if rs.canceled:
+                        _log.error('Watch canceled: %s, reason=%s',
+                                   self._key, rs.cancel_reason)
+                        # The watch may be canceled for good, e.g. if the
+                        # permissions were revoked, so the application is
+                        # told about it.
+                        if self._resync_handler:
+                            self._drain_dispatcher()
+                            start_revision = resync(
+                                self._client, self._key, self._is_prefix,
+                                self._resync_handler)
 
-                        except Exception:
-                            _log.exception('Event handler failed: %s', e)
+                        sleep(self._spin_pause)
+                        break
+
+                    # Events of a fragmented response are handled together,
+                    # for it may split events of one revision.
+                    if rs.fragment:
+                        fragments.extend(rs.events)
+                        continue
+
+                    events = rs.events
+                    if fragments:
+                        events = fragments + list(rs.events)
+                        fragments = []
+
+                    if not events:
+                        if not rs.created and not rs.canceled:
+                            # A progress notification, all events up to the
+                            # header revision have been received.
+                            start_revision = max(
+                                start_revision or self._start_revision,
+                                rs.header.revision + 1)
+                            call_progress_handler(self._progress_handler,
+                                                  self._key,
+                                                  rs.header.revision)
+                        continue
+
+                    if self._dispatcher:
+                        self._dispatcher.dispatch(
+                            self._event_handler, self._batch_events,
+                            self._key, events, rs.header.revision, self)
+                    else:
+                        call_event_handler(
+                            self._event_handler, self._batch_events,
+                            self._key, events, rs.header.revision)
+                    start_revision = events[-1].kv.mod_revision + 1
 
             except grpc.RpcError as err:
                 severity = logging.ERROR
@@ -94,6 +188,8 @@ class Watcher(object):
                 if err.code() == grpc.StatusCode.CANCELLED:
                     severity = logging.WARN
 
+                stream_err = err
+
                 _log.log(severity, 'Watch stream failed: %s', self._key)
                 sleep(self._spin_pause)
 
@@ -103,5 +199,114 @@ class Watcher(object):
 
             finally:
                 grpc_stream.close(self._client._timeout)
+                self._client._release_stream_conn(conn, stream_err)
 
         _log.info('%s stopped', self._name)
+
+    def _drain_dispatcher(self):
+        """
+        Waits for events queued for the dispatcher to be handled, so that
+        the compacted and resync handlers are called after them.
+        """
+        if self._dispatcher:
+            self._dispatcher.drain(self)
+
+
+def new_watch_create_rq(key, is_prefix=False, start_revision=0, filters=None,
+                        prev_kv=False, progress_notify=False, fragment=False):
+    rq = WatchCreateRequest(key=_utils.to_bytes(key),
+                            start_revision=start_revision,
+                            filters=[f.value for f in filters or ()],
+                            prev_kv=prev_kv,
+                            progress_notify=progress_notify,
+                            fragment=fragment)
+    if is_prefix:
+        rq.range_end = _utils.range_end(rq.key)
+
+    return rq
+
+
+def resume_compacted(client, key, is_prefix, compact_revision,
+                     compacted_handler=None, resync_handler=None):
+    """
+    Called when the revision to watch from has been compacted. Returns the
+    revision to resume watching from. If there is a compacted handler then
+    it decides. If there is a resync handler then it is called with a
+    snapshot of the watched keys and its revision, and watching resumes
+    past the snapshot. Otherwise events up to the compact revision are
+    skipped.
+    """
+    if compacted_handler:
+        return compacted_handler(compact_revision)
+
+    if resync_handler:
+        _log.warn('Watch revision compacted, resyncing: %s', key)
+        return resync(client, key, is_prefix, resync_handler)
+
+    _log.error('Watch revision compacted, events before %d are lost: %s',
+               compact_revision, key)
+    return compact_revision
+
+
+def resync(client, key, is_prefix, resync_handler):
+    """
+    Calls the resync handler with a snapshot of the watched keys and its
+    revision. Returns the revision to resume watching from, past the
+    snapshot.
+    """
+    kvs, revision = range_snapshot(client, key, is_prefix)
+    _log.info('Watch resynced at %d: %s', revision, key)
+    resync_handler(kvs, revision)
+    return revision + 1
+
+
+def range_snapshot(client, key, is_prefix=False):
+    """
+    Returns a list of KeyValues of the key, or of all keys with the given
+    prefix, along with the revision they were read at.
+    """
+    if not is_prefix:
+        rs = client.get(key)
+        return list(rs.kvs), rs.header.revision
+
+    rs = client.get(key, is_prefix=True, count_only=True)
+    revision = rs.header.revision
+    return list(client.iter_prefix(key, revision=revision)), revision
+
+
+def call_progress_handler(progress_handler, key, revision):
+    """
+    Calls the progress handler, if any, with the revision up to which all
+    events have been received. Handler failures are logged.
+    """
+    if not progress_handler:
+        return
+
+    try:
+        progress_handler(revision)
+
+    except Exception:
+        _log.exception('Progress handler failed: %s, revision=%d', key,
+                       revision)
+
+
+def call_event_handler(event_handler, batch_events, key, events, revision):
+    """
+    Calls the event handler with every event, or with all events at once
+    and the revision if `batch_events` is True. Handler failures are logged.
+    """
+    if batch_events:
+        try:
+            event_handler(events, revision)
+
+        except Exception:
+            _log.exception('Event handler failed: %s, revision=%d', key,
+                           revision)
+        return
+
+    for e in events:
+        try:
+            event_handler(e)
+
+        except Exception:
+            _log.exception('Event handler failed: %s', e)
@@ -2,7 +2,13 @@ from __future__ import absolute_import
 
 import os
 
-from etcd3 import Client, ENV_ETCD3_ENDPOINT, ENV_ETCD3_TLS, ENV_ETCD3_USER
+from nose import SkipTest
+
+from etcd3 import (AsyncClient, Client, ENV_ETCD3_ENDPOINT, ENV_ETCD3_TLS,
+                   ENV_ETCD3_USER)
+from etcd3._client import _reconnect
+from etcd3._protobuf.rpc_pb2 import CompactionRequest, StatusRequest
+from etcd3._protobuf.rpc_pb2_grpc import MaintenanceStub
 from tests.toxiproxy import ToxiProxyClient
 
 
@@ -19,12 +25,14 @@ def setup():
     if os.getenv(ENV_ETCD3_TLS):
         cert_ca = 'tests/fixtures/ca.pem'
 
+    global _clients
+    _clients = []
     global _direct_clt
-    _direct_clt = Client(seed_endpoint, user, password, cert_ca=cert_ca)
+    _direct_clt = _new_clt(seed_endpoint, user, password, cert_ca=cert_ca)
     global _aux_clt
-    _aux_clt = Client(seed_endpoint, user, password, cert_ca=cert_ca)
+    _aux_clt = _new_clt(seed_endpoint, user, password, cert_ca=cert_ca)
 
-    _aux_clt._reset_grpc_channel()
+    _aux_clt._discover_endpoints()
     discovered_endpoints = _aux_clt._endpoint_balancer._endpoints
 
     global _proxy_endpoint_index
@@ -43,14 +51,20 @@ def setup():
 
     # Proxied client is assumed to have not established a connection with Etcd.
     global _proxied_clt
-    _proxied_clt = Client(proxy_endpoints, user, password, cert_ca=cert_ca)
+    _proxied_clt = _new_clt(proxy_endpoints, user, password, cert_ca=cert_ca)
     _proxied_clt._skip_endpoint_discovery = True
 
+    global _proxied_clt_args
+    _proxied_clt_args = (proxy_endpoints, user, password, cert_ca)
+
     # Clean leftovers from previous tests.
     _aux_clt.delete('/test', is_prefix=True)
 
 
 def teardown():
+    for clt in _clients:
+        clt.close()
+
     _toxi_proxy_clt.stop()
 
 
@@ -63,6 +77,29 @@ def proxied_clt():
     return _proxied_clt
 
 
+def new_proxied_clt(**kwargs):
+    """
+    Returns a new client that connects to Etcd cluster the same way as the
+    one returned by `proxied_clt`, but with extra constructor arguments.
+    """
+    proxy_endpoints, user, password, cert_ca = _proxied_clt_args
+    clt = _new_clt(proxy_endpoints, user, password, cert_ca=cert_ca,
+                   **kwargs)
+    clt._skip_endpoint_discovery = True
+    return clt
+
+
+def new_proxied_async_clt():
+    """
+    Returns a new asyncio client that connects to Etcd cluster the same way
+    as the one returned by `proxied_clt`.
+    """
+    proxy_endpoints, user, password, cert_ca = _proxied_clt_args
+    async_clt = AsyncClient(proxy_endpoints, user, password, cert_ca=cert_ca)
+    async_clt._skip_endpoint_discovery = True
+    return async_clt
+
+
 def direct_clt():
     """
     Returns a client that connects to Etcd cluster directly.
@@ -79,6 +116,23 @@ def aux_clt():
     return _aux_clt
 
 
+def compact(revision):
+    """
+    Compacts Etcd history up to the given revision.
+    """
+    _compact(_aux_clt, CompactionRequest(revision=revision))
+
+
+def skip_unless_client_watch_ids():
+    """
+    Skips the calling test unless Etcd honors client assigned watch IDs, that
+    multiplexed watches rely on. That takes Etcd 3.4+.
+    """
+    version = _status(_aux_clt, StatusRequest()).version
+    if tuple(int(v) for v in version.split('.')[:2]) < (3, 4):
+        raise SkipTest('Etcd %s ignores client assigned watch IDs' % version)
+
+
 def disable_endpoint(endpoint=None):
     endpoint = endpoint or _proxied_clt.current_endpoint
     _update_endpoints([endpoint], enabled=False)
@@ -97,6 +151,33 @@ def enabled_all_endpoints():
     _update_endpoints(endpoints=None, enabled=True)
 
 
+def slow_down_endpoint(endpoint, latency):
+    """
+    Makes Etcd responses via the given proxied endpoint delayed by `latency`
+    milliseconds.
+    """
+    _toxi_proxy_clt.add_latency(_proxy_endpoint_index[endpoint], latency)
+
+
+def _new_clt(*args, **kwargs):
+    """
+    Returns a new client that is closed on teardown.
+    """
+    clt = Client(*args, **kwargs)
+    _clients.append(clt)
+    return clt
+
+
+@_reconnect
+def _compact(clt, conn, timeout, rq):
+    return conn.kv_stub.Compact(rq, timeout=timeout)
+
+
+@_reconnect
+def _status(clt, conn, timeout, rq):
+    return MaintenanceStub(conn.grpc_channel).Status(rq, timeout=timeout)
+
+
 def _update_endpoints(endpoints, enabled):
     for endpoint in endpoints or _proxy_endpoint_index.keys():
         proxy_name = _proxy_endpoint_index[endpoint]
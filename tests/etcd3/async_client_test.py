@@ -0,0 +1,227 @@
+from __future__ import absolute_import
+
+import asyncio
+
+from nose.tools import eq_, with_setup
+
+from etcd3 import CompareResult, _utils
+from etcd3._protobuf.kv_pb2 import Event
+from tests.etcd3 import _fixture
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_put_get_delete():
+
+    async def scenario():
+        async_clt = _fixture.new_proxied_async_clt()
+        try:
+            await async_clt.put('/test/foo1', 'bar1')
+            await async_clt.put('/test/foo2', 'bar2')
+            await async_clt.put('/test/foo3', 'bar3')
+
+            # When
+            rs = await async_clt.delete('/test/foo2')
+
+            # Then
+            eq_(1, rs.deleted)
+            eq_(b'bar1', await async_clt.get_value('/test/foo1'))
+            eq_(None, await async_clt.get_value('/test/foo2'))
+            eq_(2, await async_clt.count('/test/foo'))
+            eq_([b'/test/foo1', b'/test/foo3'],
+                await async_clt.keys('/test/foo'))
+
+        finally:
+            await async_clt.close()
+
+    _run(scenario())
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_txn():
+
+    async def scenario():
+        async_clt = _fixture.new_proxied_async_clt()
+        try:
+            # When
+            rs = await (async_clt.txn()
+                        .if_version('/test/foo', CompareResult.EQUAL, 0)
+                        .then_put('/test/foo', 'bar')
+                        .commit())
+
+            # Then
+            eq_(True, rs.succeeded)
+            eq_(b'bar', await async_clt.get_value('/test/foo'))
+
+        finally:
+            await async_clt.close()
+
+    _run(scenario())
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_txn_commit_async():
+
+    async def scenario():
+        async_clt = _fixture.new_proxied_async_clt()
+        try:
+            # When
+            rs_task = (async_clt.txn()
+                       .if_version('/test/foo', CompareResult.EQUAL, 0)
+                       .then_put('/test/foo', 'bar')
+                       .commit_async())
+
+            # Then
+            eq_(True, (await rs_task).succeeded)
+            eq_(b'bar', await async_clt.get_value('/test/foo'))
+
+        finally:
+            await async_clt.close()
+
+    _run(scenario())
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_created_outside_loop():
+    # The client can be used in an event loop other than the current one at
+    # the time it was created.
+
+    async_clt = _fixture.new_proxied_async_clt()
+
+    async def scenario():
+        try:
+            # When
+            await async_clt.put('/test/foo', 'bar')
+
+            # Then
+            eq_(b'bar', await async_clt.get_value('/test/foo'))
+
+        finally:
+            await async_clt.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(scenario())
+
+    finally:
+        loop.close()
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_watch():
+
+    async def scenario():
+        async_clt = _fixture.new_proxied_async_clt()
+        events = []
+
+        async def watch():
+            async for e in async_clt.watch('/test/foo2', is_prefix=True,
+                                           spin_pause=0.2):
+                events.append(e)
+                if len(events) == 3:
+                    return
+
+        watch_task = asyncio.ensure_future(watch())
+        try:
+            await asyncio.sleep(0.5)
+
+            # When
+            await async_clt.put('/test/foo1', 'bar1')
+            await async_clt.put('/test/foo21', 'bar2')
+            await async_clt.delete('/test/foo21')
+            await async_clt.put('/test/foo2', 'bar3')
+
+            # Then
+            await asyncio.wait_for(watch_task, 3)
+            _assert_event(Event.PUT, '/test/foo21', 'bar2', events[0])
+            _assert_event(Event.DELETE, '/test/foo21', '', events[1])
+            _assert_event(Event.PUT, '/test/foo2', 'bar3', events[2])
+
+        finally:
+            watch_task.cancel()
+            await async_clt.close()
+
+    _run(scenario())
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_watch_compacted():
+    # If the revision to watch from is compacted, then the compacted handler
+    # tells the revision to resume from, and the watch goes on past it.
+
+    async def scenario():
+        async_clt = _fixture.new_proxied_async_clt()
+        events = []
+        compact_revisions = []
+
+        put_rs = await async_clt.put('/test/foo1', 'bar1')
+        delete_rs = await async_clt.delete('/test/foo1')
+        _fixture.compact(delete_rs.header.revision)
+
+        def compacted_handler(compact_revision):
+            compact_revisions.append(compact_revision)
+            return compact_revision + 1
+
+        async def watch():
+            async for e in async_clt.watch(
+                    '/test/foo', is_prefix=True,
+                    start_revision=put_rs.header.revision, spin_pause=0.2,
+                    compacted_handler=compacted_handler):
+                events.append(e)
+                return
+
+        watch_task = asyncio.ensure_future(watch())
+        try:
+            await asyncio.sleep(0.5)
+
+            # When
+            await async_clt.put('/test/foo2', 'bar2')
+
+            # Then
+            await asyncio.wait_for(watch_task, 3)
+            eq_([delete_rs.header.revision], compact_revisions)
+            eq_(1, len(events))
+            _assert_event(Event.PUT, '/test/foo2', 'bar2', events[0])
+
+        finally:
+            watch_task.cancel()
+            await async_clt.close()
+
+    _run(scenario())
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_keep_alive():
+
+    async def scenario():
+        async_clt = _fixture.new_proxied_async_clt()
+        ttl = 2
+        keep_alive_task = asyncio.ensure_future(
+            async_clt.keep_alive('/test/keep-alive-0', 'bar', ttl))
+        try:
+            for i in range(3):
+                await asyncio.sleep(ttl - 0.5)
+                eq_(b'bar', await async_clt.get_value('/test/keep-alive-0'))
+
+            # When
+            keep_alive_task.cancel()
+            try:
+                await keep_alive_task
+            except asyncio.CancelledError:
+                pass
+
+            # Then
+            eq_(None, await async_clt.get_value('/test/keep-alive-0'))
+
+        finally:
+            await async_clt.close()
+
+    _run(scenario())
+
+
+def _assert_event(t, k, v, got):
+    eq_((t, _utils.to_bytes(k), _utils.to_bytes(v)),
+        (got.type, got.kv.key, got.kv.value))
@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+
+import logging
+import os
+import sys
+from threading import Barrier, Lock, Thread
+from time import time
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+from etcd3._channel_pool import GrpcChannelPool
+
+_THREADS = 32
+_CALLS = 200
+_BENCHMARK_THREADS = 64
+_BENCHMARK_CALLS = 200000
+
+_log = logging.getLogger(__name__)
+
+
+def test_concurrent_acquire():
+    # Calls in flight are counted without locks, yet none is lost when many
+    # threads acquire and release connections at once.
+
+    pool = GrpcChannelPool(4, _FakeConn)
+    acquired = [None] * _THREADS
+    barrier = Barrier(_THREADS + 1)
+
+    def run(i):
+        acquired[i] = [pool.acquire() for _ in range(_CALLS)]
+        barrier.wait()
+        barrier.wait()
+        for conn in acquired[i]:
+            pool.release(conn)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [Thread(target=run, args=(i,)) for i in range(_THREADS)]
+        for t in threads:
+            t.start()
+
+        # When
+        barrier.wait()
+
+        # Then: every acquired connection is counted.
+        eq_(_THREADS * _CALLS, sum(len(calls) for calls in pool._calls))
+        for conns in acquired:
+            for conn in conns:
+                eq_(False, pool.is_closed(conn))
+
+        # When
+        barrier.wait()
+        for t in threads:
+            t.join()
+
+        # Then: every release is counted too.
+        eq_([0, 0, 0, 0], [len(calls) for calls in pool._calls])
+
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+
+def test_acquire_contention():
+    # Benchmark: acquire/release pairs per second made by one and by many
+    # threads, over the lock-free pool and over a baseline that takes a lock
+    # per call as the pool used to. Rates vary by machine, so they are logged
+    # rather than asserted. Set CI in the environment to skip it.
+
+    if os.getenv('CI'):
+        raise SkipTest('Benchmarks are not run in CI')
+
+    for pool_size in (1, 4):
+        for name, pool_class in (('lock-free', GrpcChannelPool),
+                                 ('locked', _LockedPool)):
+            pool = pool_class(pool_size, _FakeConn)
+
+            # When
+            single_rate = _acquire_rate(pool, 1)
+            multi_rate = _acquire_rate(pool, _BENCHMARK_THREADS)
+
+            # Then
+            _log.info('%s pool of %d: 1 thread: %d calls/s, '
+                      '%d threads: %d calls/s', name, pool_size, single_rate,
+                      _BENCHMARK_THREADS, multi_rate)
+
+
+def _acquire_rate(pool, thread_count):
+    """
+    Returns the number of acquire/release pairs per second made by the given
+    number of threads together.
+    """
+    def run():
+        for _ in range(_BENCHMARK_CALLS // thread_count):
+            pool.release(pool.acquire())
+
+    threads = [Thread(target=run) for _ in range(thread_count)]
+    started_at = time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return _BENCHMARK_CALLS / (time() - started_at)
+
+
+class _LockedPool(GrpcChannelPool):
+    """
+    Baseline pool that serializes acquire and release on one lock.
+    """
+
+    def __init__(self, size, connect):
+        super(_LockedPool, self).__init__(size, connect)
+        self._call_mu = Lock()
+
+    def acquire(self):
+        with self._call_mu:
+            return super(_LockedPool, self).acquire()
+
+    def release(self, conn):
+        with self._call_mu:
+            super(_LockedPool, self).release(conn)
+
+
+class _FakeConn(object):
+
+    def __init__(self, slot, failed_endpoint):
+        self.slot = slot
+        self.endpoint = 'fake:%d' % slot
@@ -1,13 +1,17 @@
 from __future__ import absolute_import
 
+import os
 import re
 from contextlib import contextmanager
-from time import sleep
+from threading import Thread
+from time import sleep, time
 
 import grpc
+from nose.plugins.skip import SkipTest
 from nose.tools import assert_not_equal, assert_raises_regexp, eq_, with_setup
+from six.moves import queue
 
-from etcd3 import Client, _utils
+from etcd3 import Client, CompareResult, RetryPolicy, _utils
 from etcd3._client import SortOrder, SortTarget
 from tests.etcd3 import _fixture
 
@@ -186,6 +190,331 @@ def test_get_prefix_sort():
         eq_(tc['out'], [kv.value for kv in rs.kvs])
 
 
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_get_keys_only_count_only():
+    proxied_clt = _fixture.proxied_clt()
+
+    proxied_clt.put('/test/foo1', 'bar1')
+    proxied_clt.put('/test/foo2', 'bar2')
+    proxied_clt.put('/test/foo3', 'bar3')
+
+    # When
+    keys_only_rs = proxied_clt.get('/test/foo', is_prefix=True, keys_only=True)
+    count_only_rs = proxied_clt.get('/test/foo', is_prefix=True,
+                                    count_only=True)
+
+    # Then
+    eq_([b'/test/foo1', b'/test/foo2', b'/test/foo3'],
+        [kv.key for kv in keys_only_rs.kvs])
+    eq_([b'', b'', b''], [kv.value for kv in keys_only_rs.kvs])
+    eq_(3, count_only_rs.count)
+    eq_(0, len(count_only_rs.kvs))
+    eq_(3, proxied_clt.count('/test/foo'))
+    eq_([b'/test/foo1', b'/test/foo2', b'/test/foo3'],
+        proxied_clt.keys('/test/foo'))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_get_revision_filters():
+    proxied_clt = _fixture.proxied_clt()
+
+    put_rs = proxied_clt.put('/test/foo1', 'bar1')
+    proxied_clt.put('/test/foo2', 'bar2')
+    proxied_clt.put('/test/foo1', 'bar3')
+
+    # When/Then
+    _assert_get_one('bar1', proxied_clt.get('/test/foo1',
+                                            revision=put_rs.header.revision))
+    _assert_get_one('bar3', proxied_clt.get('/test/foo1', serializable=True))
+    rs = proxied_clt.get('/test/foo', is_prefix=True,
+                         max_create_revision=put_rs.header.revision)
+    eq_([b'bar3'], [kv.value for kv in rs.kvs])
+    rs = proxied_clt.get('/test/foo', is_prefix=True,
+                         max_mod_revision=put_rs.header.revision + 1)
+    eq_([b'bar2'], [kv.value for kv in rs.kvs])
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_coalesce_reads():
+    clt = _fixture.new_proxied_clt(coalesce_reads=True)
+    clt.put('/test/foo', 'bar')
+
+    range_count = [0]
+    orig_range = clt._range
+
+    def slow_range(rq):
+        range_count[0] += 1
+        sleep(0.5)
+        return orig_range(rq)
+
+    clt._range = slow_range
+
+    # When
+    values = []
+    threads = [Thread(target=lambda: values.append(clt.get_value('/test/foo')))
+               for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Then
+    eq_([b'bar'] * 10, values)
+    eq_(1, range_count[0])
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_get_many():
+    proxied_clt = _fixture.proxied_clt()
+
+    proxied_clt.put('/test/foo1', 'bar1')
+    proxied_clt.put('/test/foo2', 'bar2')
+    proxied_clt.put('/test/foo3', 'bar3')
+
+    # When
+    values = proxied_clt.get_many(['/test/foo1', '/test/foo3', '/test/foo4'])
+
+    # Then
+    eq_({'/test/foo1': b'bar1', '/test/foo3': b'bar3', '/test/foo4': None},
+        values)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_get_many_several_txns():
+    proxied_clt = _fixture.proxied_clt()
+
+    keys = ['/test/foo%d' % (i,) for i in range(10)]
+    for key in keys:
+        proxied_clt.put(key, key)
+
+    # When
+    values = proxied_clt.get_many(keys, max_txn_ops=3)
+
+    # Then
+    eq_({key: _utils.to_bytes(key) for key in keys}, values)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_iter_prefix():
+    proxied_clt = _fixture.proxied_clt()
+
+    for i in range(7):
+        proxied_clt.put('/test/foo%d' % (i,), 'bar%d' % (i,))
+    proxied_clt.put('/test/fox', 'bazz')
+
+    for read_ahead in [False, True]:
+        # When
+        kv_iter = proxied_clt.iter_prefix('/test/foo', page_size=2,
+                                          read_ahead=read_ahead)
+        kvs = [next(kv_iter)]
+        # Keys added in the middle of iteration are not seen, for all pages
+        # are read at the same revision.
+        proxied_clt.put('/test/foo9', 'late')
+        kvs.extend(kv_iter)
+        proxied_clt.delete('/test/foo9')
+
+        # Then
+        eq_(['bar%d' % (i,) for i in range(7)],
+            [kv.value.decode('utf-8') for kv in kvs])
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_txn():
+    proxied_clt = _fixture.proxied_clt()
+
+    # When: the key does not exist
+    rs = (proxied_clt.txn()
+          .if_version('/test/foo', CompareResult.EQUAL, 0)
+          .then_put('/test/foo', 'bar1')
+          .else_get('/test/foo')
+          .commit())
+
+    # Then: success branch is executed
+    eq_(True, rs.succeeded)
+    eq_(1, len(rs.responses))
+    _assert_get_one('bar1', proxied_clt.get('/test/foo'))
+
+    # When: the key already exists
+    rs = (proxied_clt.txn()
+          .if_version('/test/foo', CompareResult.EQUAL, 0)
+          .then_put('/test/foo', 'bar2')
+          .else_get('/test/foo')
+          .commit())
+
+    # Then: failure branch is executed
+    eq_(False, rs.succeeded)
+    _assert_get_one('bar1', rs.responses[0].response_range)
+    _assert_get_one('bar1', proxied_clt.get('/test/foo'))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_txn_compare_mod_revision():
+    proxied_clt = _fixture.proxied_clt()
+
+    put_rs = proxied_clt.put('/test/foo', 'bar1')
+    proxied_clt.put('/test/foo', 'bar2')
+
+    # When: compare-and-swap with a stale revision
+    rs = (proxied_clt.txn()
+          .if_mod_revision('/test/foo', CompareResult.EQUAL,
+                           put_rs.header.revision)
+          .then_put('/test/foo', 'bar3')
+          .commit())
+
+    # Then
+    eq_(False, rs.succeeded)
+    _assert_get_one('bar2', proxied_clt.get('/test/foo'))
+
+    # When: compare-and-swap with the current value
+    rs = (proxied_clt.txn()
+          .if_value('/test/foo', CompareResult.EQUAL, 'bar2')
+          .then_put('/test/foo', 'bar3')
+          .then_delete('/test/foo2', is_prefix=True)
+          .commit())
+
+    # Then
+    eq_(True, rs.succeeded)
+    _assert_get_one('bar3', proxied_clt.get('/test/foo'))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_put_many():
+    proxied_clt = _fixture.proxied_clt()
+
+    items = [('/test/foo%03d' % (i,), 'bar%d' % (i,)) for i in range(300)]
+
+    # When
+    results = proxied_clt.put_many(items, max_txn_ops=128)
+
+    # Then
+    eq_([128, 128, 44], [len(r.keys) for r in results])
+    eq_([None, None, None], [r.error for r in results])
+    eq_(300, proxied_clt.get('/test/foo', is_prefix=True).count)
+    _assert_get_one('bar299', proxied_clt.get('/test/foo299'))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_put_many_max_txn_bytes():
+    proxied_clt = _fixture.proxied_clt()
+
+    items = {'/test/foo%d' % (i,): 'x' * 100 for i in range(10)}
+
+    # When
+    results = proxied_clt.put_many(items, max_txn_bytes=500)
+
+    # Then: every transaction fits up to 4 operations of ~115 bytes.
+    eq_([4, 4, 2], [len(r.keys) for r in results])
+    eq_(10, proxied_clt.get('/test/foo', is_prefix=True).count)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_put_many_duplicate_keys():
+    # A key given more than once is stored once, and the last value wins.
+
+    proxied_clt = _fixture.proxied_clt()
+
+    items = [('/test/foo%d' % (i % 3,), 'bar%d' % (i,)) for i in range(10)]
+
+    # When
+    results = proxied_clt.put_many(items, max_txn_ops=2)
+
+    # Then
+    eq_([2, 1], [len(r.keys) for r in results])
+    eq_([None, None], [r.error for r in results])
+    eq_([b'bar9', b'bar7', b'bar8'],
+        [kv.value for kv in proxied_clt.get('/test/foo', is_prefix=True).kvs])
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_delete_many():
+    proxied_clt = _fixture.proxied_clt()
+
+    proxied_clt.put('/test/foo1', 'bar1')
+    proxied_clt.put('/test/foo2', 'bar2')
+    proxied_clt.put('/test/foo21', 'bar3')
+    proxied_clt.put('/test/foo3', 'bar4')
+
+    # When
+    results = proxied_clt.delete_many(['/test/foo1', '/test/foo2'],
+                                      is_prefix=True)
+
+    # Then
+    eq_(1, len(results))
+    eq_([1, 2], [op_rs.response_delete_range.deleted
+                 for op_rs in results[0].response.responses])
+    eq_(1, proxied_clt.get('/test/foo', is_prefix=True).count)
+    _assert_get_one('bar4', proxied_clt.get('/test/foo3'))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_async():
+    proxied_clt = _fixture.proxied_clt()
+
+    # When: many requests are pipelined from one thread
+    put_futures = [proxied_clt.put_async('/test/foo%d' % (i,), 'bar%d' % (i,))
+                   for i in range(10)]
+    put_rss = [f.result() for f in put_futures]
+    get_futures = [proxied_clt.get_async('/test/foo%d' % (i,))
+                   for i in range(10)]
+
+    # Then
+    eq_(10, len(set(rs.header.revision for rs in put_rss)))
+    for i, f in enumerate(get_futures):
+        _assert_get_one('bar%d' % (i,), f.result())
+
+    eq_(1, proxied_clt.delete_async('/test/foo1').result().deleted)
+    _assert_get_one(None, proxied_clt.get('/test/foo1'))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_async_auto_reconnect_node():
+    proxied_clt = _fixture.proxied_clt()
+
+    proxied_clt.put('/test/foo', 'bar')
+    endpoint = proxied_clt.current_endpoint
+
+    # When
+    _fixture.disable_endpoint(endpoint)
+    try:
+        get_futures = [proxied_clt.get_async('/test/foo') for _ in range(3)]
+
+        # Then
+        for f in get_futures:
+            _assert_get_one('bar', f.result())
+
+        assert_not_equal(endpoint, proxied_clt.current_endpoint)
+
+    finally:
+        _fixture.enable_endpoint(endpoint)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_async_done_after_retries():
+    # Done callbacks are invoked once the call succeeds on another node, not
+    # when the first attempt fails.
+
+    proxied_clt = _fixture.proxied_clt()
+    done_queue = queue.Queue()
+
+    proxied_clt.put('/test/foo', 'bar')
+    endpoint = proxied_clt.current_endpoint
+
+    # When
+    _fixture.disable_endpoint(endpoint)
+    try:
+        get_future = proxied_clt.get_async('/test/foo')
+        get_future.add_done_callback(done_queue.put)
+
+        # Then
+        done_future = done_queue.get(timeout=5)
+        eq_(True, done_future.done())
+        _assert_get_one('bar', done_future.result(timeout=0))
+        eq_(True, done_queue.empty())
+
+    finally:
+        _fixture.enable_endpoint(endpoint)
+
+
 @with_setup(_fixture.setup, _fixture.teardown)
 def test_endpoint_discovery():
     direct_clt = _fixture.direct_clt()
@@ -196,8 +525,14 @@ def test_endpoint_discovery():
     # When: any operation triggers connection & discovery, might as well be get
     direct_clt.get_value('/test/foo')
 
-    # Then: 3 endpoints are discovered.
-    discovered_endpoints = direct_clt._endpoint_balancer._endpoints
+    # Then: 3 endpoints are discovered in the background.
+    for _ in range(50):
+        discovered_endpoints = direct_clt._endpoint_balancer._endpoints
+        if len(discovered_endpoints) == 3:
+            break
+
+        sleep(0.1)
+
     eq_(3, len(set(discovered_endpoints)))
     # The position of the current endpoint is preserved.
     eq_(first_endpoint, direct_clt.current_endpoint)
@@ -265,6 +600,212 @@ def test_auto_reconnect_outage():
     _assert_get_one('bazz2', proxied_clt.get('/test/foo'))
 
 
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_channel_pool():
+    # Concurrent calls are spread over pooled channels, and a channel that
+    # lost its node is reconnected without affecting the others.
+
+    clt = _fixture.new_proxied_clt(channel_pool_size=3)
+    rs_futures = [clt.put_async('/test/foo%d' % (i,), 'bar')
+                  for i in range(30)]
+    for rs_future in rs_futures:
+        rs_future.result()
+
+    conns = clt._grpc_pool._conns
+    eq_(3, len([conn for conn in conns if conn]))
+
+    # When
+    endpoint = conns[1].endpoint
+    _fixture.disable_endpoint(endpoint)
+    try:
+
+        # Then
+        for i in range(10):
+            clt.put('/test/foo%d' % (i,), 'bazz')
+
+        for conn in clt._grpc_pool._conns:
+            assert_not_equal(endpoint, conn.endpoint)
+
+    finally:
+        _fixture.enable_endpoint(endpoint)
+
+    eq_(30, clt.count('/test/foo'))
+    eq_([0, 0, 0], [len(calls) for calls in clt._grpc_pool._calls])
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_balance_by_latency():
+    # Calls avoid a slow endpoint once its latency is observed.
+
+    clt = _fixture.new_proxied_clt(channel_pool_size=3,
+                                   balance_by_latency=True)
+    clt.put('/test/foo', 'bar')
+    for _ in range(3):
+        clt.get('/test/foo')
+
+    slow_endpoint = clt._grpc_pool._conns[0].endpoint
+    _fixture.slow_down_endpoint(slow_endpoint, 200)
+    for _ in range(3):
+        clt.get('/test/foo')
+
+    # When
+    started_at = time()
+    for _ in range(20):
+        clt.get('/test/foo')
+
+    # Then
+    assert time() - started_at < 1
+    for conn in clt._grpc_pool._conns:
+        if conn.endpoint != slow_endpoint:
+            assert (clt._endpoint_balancer.score(conn.endpoint) <
+                    clt._endpoint_balancer.score(slow_endpoint))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_retry_budget():
+    # Once the retry budget is spent calls fail without retries.
+
+    class _CountingRetryPolicy(RetryPolicy):
+
+        def __init__(self):
+            super(_CountingRetryPolicy, self).__init__(
+                max_attempts=3, budget_rate=0, budget_burst=3)
+            self.retries = []
+
+        def next_delay(self, attempt, err, time_left):
+            delay = super(_CountingRetryPolicy, self).next_delay(
+                attempt, err, time_left)
+            self.retries.append(delay is not None)
+            return delay
+
+    retry_policy = _CountingRetryPolicy()
+    clt = _fixture.new_proxied_clt(retry_policy=retry_policy)
+    clt.put('/test/foo', 'bar')
+
+    # When
+    _fixture.disable_all_endpoints()
+    try:
+        for _ in range(3):
+            with _assert_raises_grpc_error(grpc.StatusCode.UNAVAILABLE, ''):
+                clt.get('/test/foo')
+
+    finally:
+        _fixture.enabled_all_endpoints()
+
+    # Then
+    eq_([True, True, False, True, False, False], retry_policy.retries)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_deadline_exceeded_keeps_channel():
+    # A call that exceeded its deadline does not make the client reconnect.
+
+    clt = _fixture.new_proxied_clt(timeout=0.5)
+    clt.put('/test/foo', 'bar')
+    conn = clt._grpc_pool._conns[0]
+
+    # When
+    _fixture.slow_down_endpoint(conn.endpoint, 1000)
+    with _assert_raises_grpc_error(grpc.StatusCode.DEADLINE_EXCEEDED, ''):
+        clt.get('/test/foo')
+
+    # Then
+    assert clt._grpc_pool._conns[0] is conn
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_hedged_reads():
+    # Serializable reads stuck on a slow member are answered by another one.
+
+    clt = _fixture.new_proxied_clt(channel_pool_size=3, hedge_percentile=0.9)
+    clt.put('/test/foo', 'bar')
+    for _ in range(200):
+        clt.get('/test/foo', serializable=True)
+
+    # When
+    _fixture.slow_down_endpoint(clt._grpc_pool._conns[0].endpoint, 1000)
+
+    # Then
+    for _ in range(10):
+        started_at = time()
+        _assert_get_one('bar', clt.get('/test/foo', serializable=True))
+        assert time() - started_at < 0.5
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_token_renewal():
+    # The auth token is shared by all channels and is swapped on renewal
+    # without reconnecting.
+
+    clt = _fixture.new_proxied_clt(channel_pool_size=3)
+    if not clt._token_auth:
+        raise SkipTest('Authentication is not enabled')
+
+    clt.put('/test/foo', 'bar')
+    token = clt._token_auth.token
+    conns = [conn for conn in clt._grpc_pool._conns if conn]
+
+    # When
+    clt._token_auth.renew(token)
+
+    # Then
+    assert clt._token_auth.token != token
+    for _ in range(10):
+        _assert_get_one('bar', clt.get('/test/foo'))
+    for conn in conns:
+        eq_(False, clt._grpc_pool.is_closed(conn))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_close():
+    # Closing a client stops endpoint discovery and auth token renewal, and
+    # closes its channels.
+
+    clt = _fixture.new_proxied_clt(channel_pool_size=2)
+    clt._skip_endpoint_discovery = False
+    clt.put('/test/foo', 'bar')
+
+    # When
+    eq_(True, clt.close(timeout=3))
+
+    # Then
+    eq_(False, clt._endpoint_refresher._thread.is_alive())
+    if clt._token_auth:
+        eq_(False, clt._token_auth._thread.is_alive())
+    eq_((None, None), clt._grpc_pool._conns)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_fork():
+    # A client warmed up before fork works in the child over connections of
+    # its own.
+
+    clt = _fixture.new_proxied_clt()
+    clt.put('/test/foo', 'bar')
+    parent_conn = clt._grpc_pool._conns[0]
+    r, w = os.pipe()
+
+    # When
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ok = (clt.get('/test/foo').kvs[0].value == b'bar' and
+                  clt._grpc_pool._conns[0] is not parent_conn)
+            clt.put('/test/foo', 'kid')
+            os.write(w, b'1' if ok else b'0')
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    os.waitpid(pid, 0)
+
+    # Then
+    eq_(b'1', os.read(r, 1))
+    os.close(r)
+    _assert_get_one('kid', clt.get('/test/foo'))
+    eq_(parent_conn, clt._grpc_pool._conns[0])
+
+
 @with_setup(_fixture.setup, _fixture.teardown)
 def test_lease_expires():
     proxied_clt = _fixture.proxied_clt()
@@ -295,6 +836,20 @@ def test_lease_revoke():
     _assert_get_one(None, proxied_clt.get('/test/foo'))
 
 
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_lease_async():
+    proxied_clt = _fixture.proxied_clt()
+
+    rs = proxied_clt.lease_grant_async(600).result()
+    proxied_clt.put('/test/foo', 'bar', rs.ID)
+
+    # When
+    proxied_clt.lease_revoke_async(rs.ID).result()
+
+    # Then
+    _assert_get_one(None, proxied_clt.get('/test/foo'))
+
+
 @contextmanager
 def _assert_raises_grpc_error(code, pattern):
     try:
@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+
+from threading import Event, Thread
+from time import sleep
+
+from nose.tools import eq_
+
+from etcd3 import Backpressure
+from etcd3._dispatcher import EventDispatcher
+from etcd3._protobuf.kv_pb2 import Event as EtcdEvent
+from etcd3._protobuf.kv_pb2 import KeyValue
+from etcd3._watch_mux import MuxWatcher
+
+
+def test_per_key_order():
+    # Events of a key are handled in order, even by many workers.
+
+    handled = {}
+
+    def handler(e):
+        handled.setdefault(e.kv.key, []).append(e.kv.value)
+        sleep(0.001)
+
+    dispatcher = EventDispatcher('test', 4, 1024, Backpressure.BLOCK)
+    dispatcher.start()
+
+    # When
+    for i in range(50):
+        dispatcher.dispatch(handler, False, '/test/', [
+            _new_event('/test/foo%d' % (j,), str(i)) for j in range(8)], i)
+
+    # Then
+    eq_(True, dispatcher.stop(timeout=3))
+    eq_(8, len(handled))
+    for values in handled.values():
+        eq_([str(i).encode() for i in range(50)], values)
+
+
+def test_block():
+    handled = []
+    handler, release = _blocking_handler(handled)
+    dispatcher = EventDispatcher('test', 1, 1, Backpressure.BLOCK)
+    dispatcher.start()
+    _dispatch(dispatcher, handler, '/test/foo1', 'bar1')
+    _dispatch(dispatcher, handler, '/test/foo2', 'bar2')
+
+    # When
+    t = Thread(target=_dispatch,
+               args=(dispatcher, handler, '/test/foo3', 'bar3'))
+    t.start()
+    sleep(0.2)
+
+    # Then: the lane is full, so dispatching waits.
+    eq_(True, t.is_alive())
+    eq_(1, dispatcher.queue_depth)
+    release.set()
+    t.join(3)
+    eq_(True, dispatcher.stop(timeout=3))
+    eq_([b'bar1', b'bar2', b'bar3'], handled)
+
+
+def test_drain():
+    # A stopped watcher gives up dispatching that waits for a free slot, and
+    # draining waits for its pending events only.
+
+    handled = []
+    handler, release = _blocking_handler(handled)
+    watcher = _FakeWatcher()
+    dispatcher = EventDispatcher('test', 1, 1, Backpressure.BLOCK)
+    dispatcher.start()
+    _dispatch(dispatcher, handler, '/test/foo1', 'bar1', watcher)
+    _dispatch(dispatcher, handler, '/test/foo2', 'bar2', watcher)
+    t = Thread(target=_dispatch,
+               args=(dispatcher, handler, '/test/foo3', 'bar3', watcher))
+    t.start()
+    sleep(0.2)
+
+    # When
+    watcher.stopped = True
+
+    # Then
+    eq_(False, dispatcher.drain(watcher, timeout=0.2))
+    t.join(3)
+    eq_(False, t.is_alive())
+    eq_(True, dispatcher.drain(_FakeWatcher(), timeout=0))
+    release.set()
+    eq_(True, dispatcher.drain(watcher, timeout=3))
+    eq_([b'bar1', b'bar2'], handled)
+    eq_(True, dispatcher.stop(timeout=3))
+
+
+def test_compacted_after_queued_events():
+    # The compacted handler is called only after the events queued before
+    # the compaction are handled.
+
+    handled = []
+    handler, release = _blocking_handler(handled)
+    dispatcher = EventDispatcher('test', 1, 8, Backpressure.BLOCK)
+    dispatcher.start()
+    watcher = MuxWatcher(
+        _FakeMux(), '/test/foo', handler, dispatcher=dispatcher,
+        compacted_handler=lambda rev: handled.append(rev) or rev)
+    watcher.handle_events([_new_event('/test/foo', 'bar1'),
+                           _new_event('/test/foo', 'bar2')], 0)
+    handler.started.wait(3)
+
+    # When
+    t = Thread(target=watcher.handle_compacted, args=(7,))
+    t.start()
+    sleep(0.2)
+
+    # Then
+    eq_(True, t.is_alive())
+    release.set()
+    t.join(3)
+    eq_(False, t.is_alive())
+    eq_([b'bar1', b'bar2', 7], handled)
+    eq_(True, dispatcher.stop(timeout=3))
+
+
+def test_drop_oldest():
+    handled = []
+    handler, release = _blocking_handler(handled)
+    dispatcher = EventDispatcher('test', 1, 1, Backpressure.DROP_OLDEST)
+    dispatcher.start()
+    _dispatch(dispatcher, handler, '/test/foo1', 'bar1')
+    _dispatch(dispatcher, handler, '/test/foo2', 'bar2')
+
+    # When
+    _dispatch(dispatcher, handler, '/test/foo3', 'bar3')
+
+    # Then
+    eq_(1, dispatcher.queue_depth)
+    eq_(1, dispatcher.dropped)
+    release.set()
+    eq_(True, dispatcher.stop(timeout=3))
+    eq_([b'bar1', b'bar3'], handled)
+
+
+def test_coalesce():
+    handled = []
+    handler, release = _blocking_handler(handled)
+    dispatcher = EventDispatcher('test', 1, 1, Backpressure.COALESCE)
+    dispatcher.start()
+    _dispatch(dispatcher, handler, '/test/foo', 'bar1')
+    _dispatch(dispatcher, handler, '/test/foo', 'bar2')
+
+    # When
+    _dispatch(dispatcher, handler, '/test/foo', 'bar3')
+
+    # Then: the pending event is replaced by the latest one of the key.
+    eq_(1, dispatcher.queue_depth)
+    eq_(0, dispatcher.dropped)
+    release.set()
+    eq_(True, dispatcher.stop(timeout=3))
+    eq_([b'bar1', b'bar3'], handled)
+
+
+def test_coalesce_batches():
+    handled = []
+    started = Event()
+    release = Event()
+
+    def handler(events, revision):
+        started.set()
+        release.wait()
+        handled.append(([e.kv.value for e in events], revision))
+
+    dispatcher = EventDispatcher('test', 1, 1, Backpressure.COALESCE)
+    dispatcher.start()
+    dispatcher.dispatch(handler, True, '/test/', [
+        _new_event('/test/foo', 'bar1')], 1)
+    started.wait(3)
+    dispatcher.dispatch(handler, True, '/test/', [
+        _new_event('/test/foo', 'bar2')], 2)
+
+    # When
+    dispatcher.dispatch(handler, True, '/test/', [
+        _new_event('/test/foo', 'bar3')], 3)
+
+    # Then: the pending batch is merged with the new one.
+    eq_(1, dispatcher.queue_depth)
+    release.set()
+    eq_(True, dispatcher.stop(timeout=3))
+    eq_([([b'bar1'], 1), ([b'bar2', b'bar3'], 3)], handled)
+
+
+def _blocking_handler(handled):
+    """
+    Returns an event handler that holds up the first event until released,
+    so that the following ones pile up in the lane.
+    """
+    started = Event()
+    release = Event()
+
+    def handler(e):
+        started.set()
+        release.wait()
+        handled.append(e.kv.value)
+
+    handler.started = started
+    return handler, release
+
+
+def _dispatch(dispatcher, handler, key, value, watcher=None):
+    dispatcher.dispatch(handler, False, '/test/',
+                        [_new_event(key, value)], 0, watcher)
+    handler.started.wait(3)
+
+
+class _FakeMux(object):
+
+    def __init__(self):
+        self._client = None
+
+
+class _FakeWatcher(object):
+
+    def __init__(self):
+        self.stopped = False
+
+
+def _new_event(key, value):
+    return EtcdEvent(type=EtcdEvent.PUT,
+                     kv=KeyValue(key=key.encode(), value=value.encode()))
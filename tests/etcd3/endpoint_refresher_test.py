@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+
+from threading import Event
+from time import sleep, time
+
+from nose.tools import eq_
+
+from etcd3._endpoint_refresher import EndpointRefresher
+
+
+def test_hint_during_discovery():
+    # A hint that comes while discovery is in progress is not lost.
+
+    clt = _FakeClient(discovery_time=0.2)
+    refresher = EndpointRefresher(clt, interval=60)
+    refresher.start()
+    try:
+        clt.discovering.wait(3)
+
+        # When
+        refresher.hint()
+
+        # Then: discovery is repeated a second later, not in a minute.
+        started_at = time()
+        while clt.discoveries < 2 and time() - started_at < 3:
+            sleep(0.05)
+
+        eq_(2, clt.discoveries)
+
+    finally:
+        eq_(True, refresher.stop(timeout=1))
+
+
+class _FakeClient(object):
+
+    def __init__(self, discovery_time):
+        self.discovery_time = discovery_time
+        self.discovering = Event()
+        self.discoveries = 0
+
+    def _discover_endpoints(self):
+        self.discovering.set()
+        sleep(self.discovery_time)
+        self.discoveries += 1
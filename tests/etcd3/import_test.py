@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+
+import logging
+import subprocess
+import sys
+
+from nose.tools import eq_
+
+_RUNS = 5
+
+_log = logging.getLogger(__name__)
+
+
+def test_import_is_lazy():
+    # When
+    out = _run_python('import sys, etcd3; '
+                      'print(sorted(m for m in sys.modules '
+                      'if m.startswith(("grpc", "etcd3._"))))')
+
+    # Then
+    eq_('[]', out)
+
+
+def test_import_time():
+    # Importing the package is cheap compared to creating the first client.
+
+    # When
+    import_time = _median_time('import etcd3')
+    use_time = _median_time('import etcd3; etcd3.Client')
+
+    # Then
+    _log.info('import etcd3: %.1fms, first use: %.1fms',
+              import_time * 1000, use_time * 1000)
+    assert import_time * 2 < use_time
+
+
+def _median_time(stmt):
+    """
+    Returns the median time it takes a fresh interpreter to execute the
+    statement, without the interpreter startup time.
+    """
+    code = ('from time import perf_counter; started_at = perf_counter(); ' +
+            stmt + '; print(perf_counter() - started_at)')
+    times = sorted(float(_run_python(code)) for _ in range(_RUNS))
+    return times[_RUNS // 2]
+
+
+def _run_python(code):
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return out.decode().strip()
@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+
+from time import sleep
+
+from nose.tools import eq_, with_setup
+
+from tests.etcd3 import _fixture
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_mirror_load():
+    proxied_clt = _fixture.proxied_clt()
+
+    proxied_clt.put('/test/foo1', 'bar1')
+    proxied_clt.put('/test/foo2', 'bar2')
+    put_rs = proxied_clt.put('/test/foo21', 'bar3')
+    proxied_clt.put('/test/fox', 'bar4')
+
+    mirror = proxied_clt.new_prefix_mirror('/test/foo', spin_pause=0.2)
+
+    # When
+    mirror.start()
+    try:
+        # Then
+        eq_(put_rs.header.revision, mirror.revision)
+        eq_(b'bar1', mirror.get_value('/test/foo1'))
+        eq_(None, mirror.get_value('/test/fox'))
+        eq_([b'bar2', b'bar3'],
+            [kv.value for kv in mirror.get_prefix('/test/foo2')])
+
+    finally:
+        mirror.stop(timeout=1)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_mirror_follows_changes():
+    proxied_clt = _fixture.proxied_clt()
+
+    proxied_clt.put('/test/foo1', 'bar1')
+    proxied_clt.put('/test/foo2', 'bar2')
+
+    mirror = proxied_clt.new_prefix_mirror('/test/foo', spin_pause=0.2)
+    mirror.start()
+    try:
+        # When
+        proxied_clt.put('/test/foo1', 'bar3')
+        proxied_clt.delete('/test/foo2')
+        put_rs = proxied_clt.put('/test/foo3', 'bar4')
+        proxied_clt.put('/test/fox', 'bar5')
+        sleep(0.5)
+
+        # Then
+        eq_(put_rs.header.revision, mirror.revision)
+        eq_([b'/test/foo1', b'/test/foo3'],
+            [kv.key for kv in mirror.get_prefix('/test/')])
+        eq_(b'bar3', mirror.get_value('/test/foo1'))
+        eq_(None, mirror.get('/test/foo2'))
+
+    finally:
+        mirror.stop(timeout=1)
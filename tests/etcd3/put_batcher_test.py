@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+
+from nose.tools import eq_, with_setup
+
+from tests.etcd3 import _fixture
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_puts_coalesced():
+    proxied_clt = _fixture.proxied_clt()
+
+    put_batcher = proxied_clt.new_put_batcher(window=0.5)
+    put_batcher.start()
+    try:
+        # When
+        futures = [put_batcher.put('/test/foo%d' % (i % 3,), 'bar%d' % (i,))
+                   for i in range(10)]
+
+        # Then: all puts are stored by one transaction, last value wins.
+        revisions = set(f.result(timeout=3) for f in futures)
+        eq_(1, len(revisions))
+        rs = proxied_clt.get('/test/foo', is_prefix=True)
+        eq_([b'bar9', b'bar7', b'bar8'], [kv.value for kv in rs.kvs])
+        eq_(revisions, set(kv.mod_revision for kv in rs.kvs))
+
+    finally:
+        eq_(True, put_batcher.stop(timeout=3))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_max_txn_ops():
+    proxied_clt = _fixture.proxied_clt()
+
+    put_batcher = proxied_clt.new_put_batcher(window=3, max_txn_ops=4)
+    put_batcher.start()
+    try:
+        # When
+        futures = [put_batcher.put('/test/foo%d' % (i,), 'bar')
+                   for i in range(8)]
+
+        # Then: batches are committed as soon as they are full.
+        revisions = [f.result(timeout=1) for f in futures]
+        eq_(2, len(set(revisions)))
+        eq_(8, proxied_clt.count('/test/foo'))
+
+    finally:
+        eq_(True, put_batcher.stop(timeout=3))
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_stop_commits_pending():
+    proxied_clt = _fixture.proxied_clt()
+
+    put_batcher = proxied_clt.new_put_batcher(window=60)
+    put_batcher.start()
+    put_future = put_batcher.put('/test/foo', 'bar')
+
+    # When
+    eq_(True, put_batcher.stop(timeout=3))
+
+    # Then
+    eq_(put_future.result(timeout=0),
+        proxied_clt.get('/test/foo').kvs[0].mod_revision)
@@ -5,7 +5,7 @@ from time import sleep
 from nose.tools import eq_, with_setup, assert_not_equal
 from six.moves import queue
 
-from etcd3 import _utils
+from etcd3 import WatchFilter, _utils
 from etcd3._protobuf.kv_pb2 import Event
 from tests.etcd3 import _fixture
 
@@ -272,6 +272,248 @@ def test_handler_exception():
         w.stop(timeout=1)
 
 
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_batch_events():
+    # All events of a transaction are handled at once.
+
+    proxied_clt = _fixture.proxied_clt()
+    watch_queue = queue.Queue()
+
+    proxied_clt.put('/test/foo0', 'bar0')
+    w = proxied_clt.new_watcher(
+        '/test/foo', is_prefix=True, spin_pause=0.2, batch_events=True,
+        event_handler=lambda events, rev: watch_queue.put((events, rev)))
+    w.start()
+    try:
+        sleep(0.5)
+
+        # When
+        rs = (proxied_clt.txn()
+              .then_put('/test/foo1', 'bar1')
+              .then_put('/test/foo2', 'bar2')
+              .then_delete('/test/foo0')
+              .commit())
+
+        # Then
+        batches = _collect_events(watch_queue, timeout=3)
+        eq_(1, len(batches))
+        events, revision = batches[0]
+        eq_(rs.header.revision, revision)
+        eq_(3, len(events))
+        _assert_event(Event.PUT, '/test/foo1', 'bar1', events[0])
+        _assert_event(Event.PUT, '/test/foo2', 'bar2', events[1])
+        _assert_event(Event.DELETE, '/test/foo0', '', events[2])
+
+    finally:
+        w.stop(timeout=1)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_multiplexed():
+    # Watches share one stream, and events are routed to the right watch.
+    _fixture.skip_unless_client_watch_ids()
+
+    proxied_clt = _fixture.new_proxied_clt(multiplex_watches=True)
+    watch_queues = [queue.Queue() for _ in range(3)]
+    watchers = [proxied_clt.new_watcher('/test/foo%d' % (i,), spin_pause=0.2,
+                                        event_handler=q.put)
+                for i, q in enumerate(watch_queues)]
+    for w in watchers:
+        w.start()
+    try:
+        sleep(0.5)
+
+        # When
+        eq_(True, watchers[2].stop(timeout=1))
+        for i in range(3):
+            proxied_clt.put('/test/foo%d' % (i,), 'bar%d' % (i,))
+
+        # Then
+        for i in range(2):
+            events = _collect_events(watch_queues[i], timeout=3)
+            eq_(1, len(events))
+            _assert_event(Event.PUT, '/test/foo%d' % (i,), 'bar%d' % (i,),
+                          events[0])
+
+        eq_(0, watch_queues[2].qsize())
+
+    finally:
+        for w in watchers:
+            w.stop(timeout=1)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_multiplexed_auto_reconnect():
+    # All watches of a failed stream are resumed without missing events.
+    _fixture.skip_unless_client_watch_ids()
+
+    proxied_clt = _fixture.new_proxied_clt(multiplex_watches=True)
+    watch_queue = queue.Queue()
+    watchers = [proxied_clt.new_watcher('/test/foo%d' % (i,), spin_pause=0.2,
+                                        event_handler=watch_queue.put)
+                for i in range(3)]
+    for w in watchers:
+        w.start()
+    try:
+        sleep(0.5)
+        orig_endpoint = proxied_clt.current_endpoint
+
+        # When
+        _fixture.disable_endpoint(orig_endpoint)
+        for i in range(3):
+            _fixture.aux_clt().put('/test/foo%d' % (i,), 'bar%d' % (i,))
+
+        # Then
+        events = _collect_events(watch_queue, timeout=3)
+        eq_(3, len(events))
+        eq_([b'bar0', b'bar1', b'bar2'], sorted(e.kv.value for e in events))
+        assert_not_equal(orig_endpoint, proxied_clt.current_endpoint)
+
+    finally:
+        for w in watchers:
+            w.stop(timeout=1)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_multiplexed_resync_compacted():
+    # A multiplexed watch canceled due to compaction is created again under
+    # a new ID, for Etcd keeps the old one in use.
+    _fixture.skip_unless_client_watch_ids()
+
+    proxied_clt = _fixture.new_proxied_clt(multiplex_watches=True)
+    watch_queue = queue.Queue()
+    resync_queue = queue.Queue()
+
+    put_rs = proxied_clt.put('/test/foo1', 'bar1')
+    delete_rs = proxied_clt.delete('/test/foo1')
+    _fixture.compact(delete_rs.header.revision)
+
+    w = proxied_clt.new_watcher(
+        '/test/foo', is_prefix=True, spin_pause=0.2,
+        start_revision=put_rs.header.revision, event_handler=watch_queue.put,
+        resync_handler=lambda kvs, rev: resync_queue.put((kvs, rev)))
+
+    # When
+    w.start()
+    try:
+        sleep(0.5)
+        proxied_clt.put('/test/foo2', 'bar2')
+
+        # Then
+        kvs, revision = resync_queue.get(timeout=3)
+        eq_(delete_rs.header.revision, revision)
+        eq_([], kvs)
+        events = _collect_events(watch_queue, timeout=3)
+        eq_(1, len(events))
+        _assert_event(Event.PUT, '/test/foo2', 'bar2', events[0])
+
+    finally:
+        w.stop(timeout=1)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_filters_prev_kv():
+    # Only delete events are sent, and they carry the deleted value.
+
+    proxied_clt = _fixture.proxied_clt()
+    watch_queue = queue.Queue()
+
+    w = proxied_clt.new_watcher('/test/foo', is_prefix=True, spin_pause=0.2,
+                                event_handler=watch_queue.put,
+                                filters=[WatchFilter.NOPUT], prev_kv=True)
+    w.start()
+    try:
+        sleep(0.5)
+
+        # When
+        proxied_clt.put('/test/foo1', 'bar1')
+        proxied_clt.put('/test/foo2', 'bar2')
+        proxied_clt.delete('/test/foo1')
+
+        # Then
+        events = _collect_events(watch_queue, timeout=3)
+        eq_(1, len(events))
+        _assert_event(Event.DELETE, '/test/foo1', '', events[0])
+        eq_(_utils.to_bytes('bar1'), events[0].prev_kv.value)
+
+    finally:
+        w.stop(timeout=1)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_resync_compacted():
+    # If the revision to resume from is compacted, then the watch is resynced
+    # from a snapshot of the prefix and continues past it.
+
+    proxied_clt = _fixture.proxied_clt()
+    watch_queue = queue.Queue()
+    resync_queue = queue.Queue()
+
+    put_rs = proxied_clt.put('/test/foo1', 'bar1')
+    proxied_clt.put('/test/foo2', 'bar2')
+    delete_rs = proxied_clt.delete('/test/foo1')
+    _fixture.compact(delete_rs.header.revision)
+
+    w = proxied_clt.new_watcher(
+        '/test/foo', is_prefix=True, spin_pause=0.2,
+        start_revision=put_rs.header.revision, event_handler=watch_queue.put,
+        resync_handler=lambda kvs, rev: resync_queue.put((kvs, rev)))
+
+    # When
+    w.start()
+    try:
+        sleep(0.5)
+        proxied_clt.put('/test/foo3', 'bar3')
+
+        # Then
+        kvs, revision = resync_queue.get(timeout=3)
+        eq_(delete_rs.header.revision, revision)
+        eq_([(b'/test/foo2', b'bar2')], [(kv.key, kv.value) for kv in kvs])
+        events = _collect_events(watch_queue, timeout=3)
+        eq_(1, len(events))
+        _assert_event(Event.PUT, '/test/foo3', 'bar3', events[0])
+
+    finally:
+        w.stop(timeout=1)
+
+
+@with_setup(_fixture.setup, _fixture.teardown)
+def test_dispatcher():
+    # A slow handler runs on dispatcher workers, in order for every key.
+
+    proxied_clt = _fixture.proxied_clt()
+    watch_queue = queue.Queue()
+
+    def handler(e):
+        sleep(0.2)
+        watch_queue.put(e)
+
+    dispatcher = proxied_clt.new_event_dispatcher(workers=8)
+    dispatcher.start()
+    w = proxied_clt.new_watcher('/test/foo', handler, is_prefix=True,
+                                spin_pause=0.2, dispatcher=dispatcher)
+    w.start()
+    try:
+        sleep(0.5)
+
+        # When
+        for i in range(2):
+            for j in range(8):
+                proxied_clt.put('/test/foo%d' % (j,), 'bar%d' % (i,))
+
+        # Then
+        events = _collect_events(watch_queue, timeout=1.5)
+        eq_(16, len(events))
+        for j in range(8):
+            eq_([b'bar0', b'bar1'],
+                [e.kv.value for e in events
+                 if e.kv.key == _utils.to_bytes('/test/foo%d' % (j,))])
+
+    finally:
+        w.stop(timeout=1)
+        dispatcher.stop(timeout=1)
+
+
 def _assert_event(t, k, v, got):
     eq_((t, _utils.to_bytes(k), _utils.to_bytes(v)),
         (got.type, got.kv.key, got.kv.value))
@@ -76,6 +76,22 @@ class ToxiProxyClient(object):
             raise RuntimeError('Failed to update proxy: %d %s'
                                % (rs.status_code, rs.text))
 
+    def add_latency(self, proxy_name, latency):
+        """
+        Delays data sent from upstream through the proxy by `latency`
+        milliseconds.
+        """
+        url = self._api_base_url + '/proxies/' + proxy_name + '/toxics'
+        json_rq = {
+            'type': 'latency',
+            'stream': 'downstream',
+            'attributes': {'latency': latency},
+        }
+        rs = requests.post(url, json=json_rq)
+        if rs.status_code != http_client.OK:
+            raise RuntimeError('Failed to add latency: %d %s'
+                               % (rs.status_code, rs.text))
+
     def _download_binary(self):
         system = platform.system().lower()
         url = ('https://github.com/Shopify/toxiproxy/releases/download/%s'